@@ -0,0 +1,50 @@
+# Benchmark showing how DataFlow propagation cost scales with graph size
+#
+# Run with: python benchmarks/dataflow_scaling.py
+from __future__ import absolute_import, print_function
+
+import timeit
+import param
+
+from boxflow.dataflow import DataFlow
+from boxflow.interface.inventory import BoxType
+
+
+class Relay(param.Parameterized):
+
+    value = param.Number(default=0)
+
+    def propagate(self):
+        return self.value
+
+
+relay = BoxType(Relay)
+
+
+def chains(count, length):
+    """
+    Return a DataFlow holding count independent chains of the given
+    length. The first box of chain k is named 'chain-k-0'.
+    """
+    dataflow = DataFlow()
+    for k in range(count):
+        names = ['chain-%d-%d' % (k, i) for i in range(length)]
+        for name in names:
+            dataflow.add_box(relay(None, name=name))
+        for (src, dest) in zip(names[:-1], names[1:]):
+            dataflow.add_link(src, '', dest, 'value')
+    return dataflow
+
+
+def propagation(count, length=5, repeat=200):
+    "Mean seconds per update_params call at the head of one chain"
+    dataflow = chains(count, length)
+    timer = timeit.Timer(lambda: dataflow.update_params('chain-0-0',
+                                                        {'value':1}))
+    return min(timer.repeat(3, repeat)) / repeat
+
+
+if __name__ == '__main__':
+    print('%8s %8s %14s' % ('boxes', 'updated', 'us/update'))
+    for count in [1, 10, 100, 1000]:
+        print('%8d %8d %14.1f' % (count * 5, 5, propagation(count) * 1e6))
@@ -0,0 +1,266 @@
+# Benchmark suite measuring the hot paths with comparable JSON results
+#
+# Synthetic graphs (chains, fans, diamonds and grids) of param/numbergen
+# boxes and of imagen boxes (if imagen is installed) are used to time
+# DataFlow.add_link, update_params propagation and bulk imports. The
+# suite also times Inventory.json, imagen_display rendering plus
+# encoding and a websocket round-trip through a local Tornado server.
+#
+# Every result records the best and mean seconds per operation so that
+# runs on the same machine may be compared across releases:
+#
+# Run with: python benchmarks/suite.py --output results.json
+#           python benchmarks/suite.py --compare results.json
+from __future__ import absolute_import, print_function, division
+
+import sys
+import json
+import time
+import argparse
+import platform
+from timeit import default_timer
+
+import numpy as np
+import param
+import tornado
+
+from boxflow.interface import Inventory
+from boxflow.dataflow import DataFlow
+from boxflow import graph
+
+excluded = ['enforce_minimal_thickness', 'size', 'time_dependent', 'seed']
+
+
+def timed(fn, repeat=5, number=1):
+    "Return the (best, mean) seconds per call of fn over repeat runs"
+    times = []
+    for _ in range(repeat):
+        start = default_timer()
+        for _ in range(number):
+            fn()
+        times.append((default_timer() - start) / number)
+    return min(times), sum(times) / len(times)
+
+
+# Synthetic graphs as (boxes, links, root) where boxes are (type, name,
+# params) tuples and links are (src, output, dest, input) tuples.
+
+def chain(size, node, inputs):
+    names = ['chain-%d' % i for i in range(size)]
+    links = [(s, '', d, inputs[0]) for (s, d) in zip(names[:-1], names[1:])]
+    return [node(n) for n in names], links, names[0]
+
+
+def fan(size, node, inputs):
+    names = ['fan-%d' % i for i in range(size)]
+    links = [(names[0], '', d, inputs[0]) for d in names[1:]]
+    return [node(n) for n in names], links, names[0]
+
+
+def diamonds(size, node, inputs):
+    "Successive diamonds each joining two branches into the next top"
+    names, links, top = ['diamond-0'], [], 'diamond-0'
+    for k in range(1, size // 3 + 1):
+        left, right, bottom = ['diamond-%d-%s' % (k, s) for s in 'lrb']
+        names += [left, right, bottom]
+        links += [(top, '', left, inputs[0]), (top, '', right, inputs[0]),
+                  (left, '', bottom, inputs[0]), (right, '', bottom, inputs[-1])]
+        top = bottom
+    return [node(n) for n in names], links, names[0]
+
+
+def grid(size, node, inputs):
+    "Square grid with each box fed from the boxes above and to the left"
+    side = max(int(round(size ** 0.5)), 2)
+    name = lambda i, j: 'grid-%d-%d' % (i, j)
+    names, links = [], []
+    for i in range(side):
+        for j in range(side):
+            names.append(name(i, j))
+            if i > 0:
+                links.append((name(i - 1, j), '', name(i, j), inputs[0]))
+            if j > 0:
+                links.append((name(i, j - 1), '', name(i, j), inputs[-1]))
+    return [node(n) for n in names], links, names[0]
+
+
+topologies = [('chain', chain), ('fan', fan),
+              ('diamonds', diamonds), ('grid', grid)]
+
+
+def numbergen_node(name):
+    return ('numbergen.BinaryOp', name, {'operator':'add'})
+
+
+def imagen_node(name):
+    return ('imagen.Mul', name, {})
+
+
+def build(boxes, links):
+    "Build a DataFlow one add_box/add_link at a time"
+    dataflow = DataFlow()
+    for (type_name, name, params) in boxes:
+        boxtype = Inventory.lookup_boxtype(type_name)
+        dataflow.add_box(boxtype(Inventory, name=name, **params))
+    for link in links:
+        dataflow.add_link(*link)
+    return dataflow
+
+
+def document(boxes, links):
+    return {'version': graph.version,
+            'boxes': [{'type':t, 'name':n, 'params':p} for (t,n,p) in boxes],
+            'links': [{'src':s, 'output':o, 'dest':d, 'input':i}
+                      for (s,o,d,i) in links]}
+
+
+def dataflow_benchmarks(results, size, label, node, inputs, update):
+    for topology, generate in topologies:
+        boxes, links, root = generate(size, node, inputs)
+        key = '%s/%s-%d' % (label, topology, size)
+        params = {'boxes': len(boxes), 'links': len(links)}
+
+        best, mean = timed(lambda: build(boxes, links), repeat=3)
+        results['add_link/' + key] = dict(params, best=best / len(links),
+                                          mean=mean / len(links))
+        doc = document(boxes, links)
+        best, mean = timed(lambda: graph.import_graph(doc, Inventory), repeat=3)
+        results['add_graph/' + key] = dict(params, best=best, mean=mean)
+
+        dataflow = build(boxes, links)
+        values = iter(range(10**9))
+        best, mean = timed(lambda: dataflow.update_params(root, update(next(values))),
+                           repeat=5, number=5)
+        results['update_params/' + key] = dict(params, best=best, mean=mean)
+
+
+def imagen_benchmarks(results, transports=('json', 'raw', 'png')):
+    from boxflow.interface.imagen import imagen_display
+    from boxflow.transport import encode_message
+    gaussian = Inventory.lookup_boxtype('imagen.Gaussian')
+    blur = Inventory.lookup_boxtype('imagen.Blur')
+    for density in [128, 256, 512]:
+        source = gaussian(Inventory, name='gaussian', xdensity=density,
+                          ydensity=density)
+        box = blur(Inventory, name='blur', xdensity=density, ydensity=density,
+                   input=source.instance)
+        best, mean = timed(lambda: imagen_display(box.instance), repeat=3)
+        results['imagen_display/blur-%d' % density] = dict(best=best, mean=mean)
+        data = dict(imagen_display(box.instance), name='blur')
+        for transport in transports:
+            best, mean = timed(lambda: encode_message('image_update', data,
+                                                      transport), repeat=3)
+            results['encode/%s-%d' % (transport, density)] = dict(best=best,
+                                                                  mean=mean)
+
+
+def inventory_benchmarks(results):
+    best, mean = timed(lambda: Inventory.json(excluded, 'datgui'), repeat=5)
+    results['inventory_json'] = dict(best=best, mean=mean,
+                                     types=len(Inventory.json(excluded, 'datgui')))
+
+
+def roundtrip_benchmarks(results, repeat=50):
+    """
+    Time trigger_button messages answered by a param_update through a
+    local websocket server (including the Command dispatch).
+    """
+    import tornado.web
+    from tornado.ioloop import IOLoop
+    from tornado.httpserver import HTTPServer
+    from tornado.testing import bind_unused_port
+    from tornado.websocket import websocket_connect
+    from boxflow.server import WSHandler
+
+    async def run():
+        sock, port = bind_unused_port()
+        server = HTTPServer(tornado.web.Application([
+            (r'/ws', WSHandler, {'latency': 0, 'preview': False})]))
+        server.add_sockets([sock])
+        conn = await websocket_connect('ws://127.0.0.1:%d/ws' % port)
+        await conn.read_message() # Definitions
+        conn.write_message(json.dumps({'command':'add_node', 'data':
+                                       {'type':'ToolBox', 'name':'toolbox',
+                                        'params':{}}}))
+        await conn.read_message() # Initial display
+        times = []
+        for _ in range(repeat):
+            start = default_timer()
+            conn.write_message(json.dumps({'command':'trigger_button', 'data':
+                                           {'name':'toolbox',
+                                            'button':'randomize'}}))
+            while json.loads(await conn.read_message())['command'] != 'param_update':
+                pass
+            times.append(default_timer() - start)
+        conn.close()
+        server.stop()
+        return times
+
+    times = IOLoop.current().run_sync(run)
+    results['roundtrip/trigger_button'] = dict(best=min(times),
+                                               mean=sum(times) / len(times))
+
+
+def run(sizes=(10, 100)):
+    results = {}
+    Inventory.load()
+    for size in sizes:
+        dataflow_benchmarks(results, size, 'numbergen', numbergen_node,
+                            ['lhs', 'rhs'], lambda v: {'lhs': v})
+    if 'imagen' in Inventory.definitions:
+        for size in sizes:
+            dataflow_benchmarks(results, size, 'imagen', imagen_node,
+                                ['lhs', 'rhs'], lambda v: {'scale': 1 + v % 2})
+        imagen_benchmarks(results)
+    else:
+        print('Skipping the imagen benchmarks (imagen is not installed)')
+    inventory_benchmarks(results)
+    roundtrip_benchmarks(results)
+    return {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                     'platform': platform.platform(),
+                     'python': platform.python_version(),
+                     'numpy': np.__version__,
+                     'param': param.__version__,
+                     'tornado': tornado.version},
+            'results': results}
+
+
+def compare(current, baseline, threshold=0.25):
+    """
+    Print the ratio of the best times of the current results to the
+    baseline, returning the names of the benchmarks slower by more
+    than the threshold.
+    """
+    regressions = []
+    print('%-40s %12s %12s %8s' % ('benchmark', 'baseline', 'current', 'ratio'))
+    for name in sorted(set(current['results']) & set(baseline['results'])):
+        before = baseline['results'][name]['best']
+        after = current['results'][name]['best']
+        ratio = after / before if before else float('inf')
+        flag = ' *' if ratio > 1 + threshold else ''
+        print('%-40s %10.1fus %10.1fus %8.2f%s' % (name, before * 1e6,
+                                                   after * 1e6, ratio, flag))
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the boxflow benchmarks.')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', help='Compare to results in this JSON file.')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Slowdown ratio above 1 flagged as a regression.')
+    args = parser.parse_args()
+
+    results = run()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        sys.exit(1 if regressions else 0)
+    else:
+        for name, result in sorted(results['results'].items()):
+            print('%-40s %10.1fus' % (name, result['best'] * 1e6))
@@ -0,0 +1,37 @@
+# Benchmark comparing the bytes sent and encode time of image transports
+#
+# Run with: python benchmarks/transport.py
+from __future__ import absolute_import, print_function
+
+import timeit
+import numpy as np
+
+from boxflow.transport import encode_message
+
+
+def pattern(size):
+    "A Gabor-like test pattern with values in [0,1]"
+    x, y = np.meshgrid(np.linspace(-0.5, 0.5, size), np.linspace(-0.5, 0.5, size))
+    envelope = np.exp(-(x**2 + y**2) / (2 * 0.15**2))
+    return 0.5 + 0.5 * envelope * np.sin(2 * np.pi * 8 * x)
+
+
+def measure(arr, transport, compress_level=1, repeat=5):
+    "Return (bytes sent, seconds per encode) for the given transport"
+    data = {'name':'benchmark', 'image':arr}
+    message, _ = encode_message('image_update', data, transport, compress_level)
+    timer = timeit.Timer(lambda: encode_message('image_update', data,
+                                                transport, compress_level))
+    return len(message), min(timer.repeat(3, repeat)) / repeat
+
+
+configurations = [('json', 1), ('raw', 1), ('png', 0), ('png', 1), ('png', 6)]
+
+if __name__ == '__main__':
+    print('%6s %12s %12s %10s' % ('size', 'transport', 'bytes', 'ms/frame'))
+    for size in [256, 512, 1024]:
+        arr = pattern(size)
+        for (transport, level) in configurations:
+            label = transport if transport != 'png' else 'png-%d' % level
+            nbytes, seconds = measure(arr, transport, level)
+            print('%6d %12s %12d %10.2f' % (size, label, nbytes, seconds * 1e3))
@@ -0,0 +1,220 @@
+# Module evaluating saved graphs headless over parameter sweeps
+#
+# Run with: boxflow-batch graph.json --sweep Disk00001.size=0.1:1:10 \
+#                          --outputs Viewport00001 --processes 4
+#
+# Each point of the sweep (the product of the swept values) is evaluated
+# in a pool of processes, each holding its own copy of the graph. The
+# special parameter name 'time' sweeps param.Dynamic.time_fn, taking
+# precedence over the Time boxes of the graph (set to each time). Sweeps
+# over time alone of outputs offering vectorized samples (such as the
+# numbergen boxes) are computed in one call per output instead.
+from __future__ import absolute_import, print_function
+
+import os
+import json
+import argparse
+import fractions
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import param
+
+from . import graph
+from .transport import image_to_png
+
+formats = ['npy', 'png', 'stack']
+
+_dataflow = None # DataFlow of the worker process
+
+
+def parse_values(spec):
+    """
+    Parse swept values given as 'start:stop:num' (inclusive linear
+    spacing) or as a comma separated list.
+    """
+    if ':' in spec:
+        start, stop, num = spec.split(':')
+        return [float(v) for v in np.linspace(float(start), float(stop), int(num))]
+    return [json.loads(v) for v in spec.split(',')]
+
+
+def points(sweeps):
+    """
+    Given an ordered list of (parameter, values) tuples, return the list
+    of dictionaries of parameter values at each point of the sweep.
+    """
+    names = [name for (name, _) in sweeps]
+    return [dict(zip(names, values))
+            for values in itertools.product(*[v for (_, v) in sweeps])]
+
+
+def evaluate_point(dataflow, point, outputs):
+    """
+    Set the parameters of the given sweep point (keyed by 'box.param'
+    or 'time') and return a dictionary of output box name to array. A
+    swept time is also set on every Time box, which would otherwise set
+    the time it holds when refreshed.
+    """
+    updates = {}
+    for key, value in point.items():
+        if key == 'time':
+            time = fractions.Fraction(str(value))
+            param.Dynamic.time_fn(time)
+            for name, box in dataflow.boxes.items():
+                if getattr(box.instance, 'playback', False): # Time boxes
+                    updates.setdefault(name, {})['time'] = time
+        else:
+            name, pname = key.split('.', 1)
+            updates.setdefault(name, {})[pname] = value
+    for name, params in updates.items():
+        dataflow.update_params(name, params)
+    dataflow.refresh_time() # Boxes depending on the time alone
+
+    results = {}
+    for name in outputs:
+        box = dataflow.find_box(name)
+        if box is None:
+            raise Exception('No box named %r' % name)
+        value = box.display().get('image')
+        if value is None:
+            value = box.propagate()
+            value = value() if callable(value) else value # e.g. numbergen
+        results[name] = np.asarray(value)
+    return results
+
+
+def sample_outputs(dataflow, sweeps, outputs):
+    """
+    If only time is swept and every output box propagates an object
+    with a samples method (see interface.numbergen), return the list of
+    dictionaries of output box name to value at each point of the sweep,
+    computed in one vectorized call per output. Otherwise return None.
+    """
+    if [name for (name, _) in sweeps] != ['time']:
+        return None
+    sources = {}
+    for name in outputs:
+        box = dataflow.find_box(name)
+        if box is None:
+            raise Exception('No box named %r' % name)
+        sources[name] = box.propagate()
+        if not hasattr(sources[name], 'samples'):
+            return None
+    times = [fractions.Fraction(str(value)) for value in sweeps[0][1]]
+    memo = {} # Generators shared by several outputs are sampled once
+    arrays = {name: source.samples(times, memo) for name, source in sources.items()}
+    return [{name: arr[i] for name, arr in arrays.items()}
+            for i in range(len(times))]
+
+
+def output_path(out_dir, name, index, ext):
+    return os.path.join(out_dir, '%s-%05d.%s' % (name, index, ext))
+
+
+def write_outputs(results, index, out_dir, fmt):
+    "Write the results of one sweep point as .npy/.png files or into stacks"
+    for name, arr in results.items():
+        if fmt == 'npy':
+            np.save(output_path(out_dir, name, index, 'npy'), arr)
+        elif fmt == 'png':
+            with open(output_path(out_dir, name, index, 'png'), 'wb') as f:
+                f.write(image_to_png(arr))
+        else:
+            stack = np.load(os.path.join(out_dir, name + '.npy'), mmap_mode='r+')
+            stack[index] = arr
+            stack.flush()
+
+
+def _initialize(document):
+    "Build the graph once per worker process"
+    global _dataflow
+    from .interface import Inventory
+    _dataflow, _ = graph.import_graph(document, Inventory)
+
+
+def _run(index, point, outputs, out_dir, fmt):
+    write_outputs(evaluate_point(_dataflow, point, outputs), index, out_dir, fmt)
+    return index
+
+
+def sweep(document, sweeps, outputs, out_dir='.', fmt='npy', processes=None):
+    """
+    Evaluate the graph document at every point of the given sweeps
+    (see points), writing the arrays of the named output boxes to
+    out_dir as one file per point and box ('npy' or 'png') or as one
+    memory-mapped .npy stack per box ('stack'). A manifest.json file
+    lists the parameter values of each point by index.
+
+    The first point is evaluated in this process (to validate the graph
+    and size the stacks) and the others in a pool of processes, unless
+    the outputs may be sampled over a time sweep at once (see
+    sample_outputs).
+    """
+    from .interface import Inventory
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    sweep_points = points(sweeps)
+    with open(os.path.join(out_dir, 'manifest.json'), 'w') as f:
+        json.dump({'outputs': outputs, 'format': fmt,
+                   'points': sweep_points}, f, indent=1)
+
+    dataflow, _ = graph.import_graph(document, Inventory)
+    sampled = sample_outputs(dataflow, sweeps, outputs)
+    first = (sampled[0] if sampled is not None
+             else evaluate_point(dataflow, sweep_points[0], outputs))
+    if fmt == 'stack':
+        for name, arr in first.items():
+            np.lib.format.open_memmap(os.path.join(out_dir, name + '.npy'), mode='w+',
+                                      dtype=arr.dtype,
+                                      shape=(len(sweep_points),) + arr.shape)
+    write_outputs(first, 0, out_dir, fmt)
+
+    if sampled is not None:
+        for index, results in enumerate(sampled[1:], 1):
+            write_outputs(results, index, out_dir, fmt)
+        return len(sweep_points)
+
+    if processes == 1:
+        for index, point in enumerate(sweep_points[1:], 1):
+            write_outputs(evaluate_point(dataflow, point, outputs),
+                          index, out_dir, fmt)
+        return len(sweep_points)
+
+    with ProcessPoolExecutor(processes, initializer=_initialize,
+                             initargs=(document,)) as executor:
+        futures = [executor.submit(_run, index, point, outputs, out_dir, fmt)
+                   for index, point in enumerate(sweep_points[1:], 1)]
+        for future in futures:
+            future.result() # Raise any exception from the workers
+    return len(sweep_points)
+
+
+def console_script():
+    parser = argparse.ArgumentParser(
+        description='Evaluate a saved boxflow graph over parameter sweeps.')
+    parser.add_argument('graph', help='Graph document saved as JSON.')
+    parser.add_argument('--sweep', action='append', default=[],
+                        metavar='BOX.PARAM=VALUES',
+                        help="Values as 'start:stop:num' or a comma separated "
+                        "list (use 'time' to sweep the global time, which "
+                        "then also sets the time of any Time box of the "
+                        "graph). May be repeated to sweep the product of "
+                        "the values.")
+    parser.add_argument('--outputs', required=True,
+                        help='Comma separated names of the boxes to write.')
+    parser.add_argument('--out-dir', default='.',
+                        help='Directory receiving the outputs (default .).')
+    parser.add_argument('--format', choices=formats, default='npy',
+                        help='One .npy or .png file per point and box, or a '
+                        'memory-mapped .npy stack per box.')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Number of worker processes (default one per core).')
+    args = parser.parse_args()
+
+    sweeps = [tuple(s.split('=', 1)) for s in args.sweep]
+    sweeps = [(name, parse_values(values)) for (name, values) in sweeps]
+    count = sweep(graph.load(args.graph), sweeps, args.outputs.split(','),
+                  args.out_dir, args.format, args.processes)
+    print('Wrote %d points to %s' % (count, args.out_dir))
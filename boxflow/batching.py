@@ -0,0 +1,179 @@
+# Module evaluating boxes over batches of parameter values
+#
+# Sweep and Grid boxes (see interface.param) propagate Batch values:
+# arrays with one dimension per named batch axis. The DataFlow expands
+# every Batch to the axes of the whole graph (with unit dimensions for
+# the axes it does not vary over) so that batches over different axes
+# broadcast to their Cartesian product. Boxes fed batches evaluate to
+# stacks of images shaped by the batch axes followed by the image shape
+# and operators over stacks simply broadcast. Batches and stacks over the
+# same axis are zipped rather than multiplied.
+from __future__ import absolute_import
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+# Parameters defining the coordinate grids of a pattern, never vectorized
+spatial = set(['x', 'y', 'orientation', 'bounds', 'xdensity', 'ydensity'])
+
+_scalar = set() # (type, parameter names) of batches found not to vectorize
+
+_point = threading.local() # Batch point evaluated by each thread (see at_point)
+
+
+class Batch(object):
+    """
+    Values of a numeric parameter over the named batch axes, held in a
+    read-only array with one dimension per axis (in the order of axes).
+    """
+
+    def __init__(self, axes, values, dtype=float):
+        self.axes = list(axes)
+        self.values = np.array(values, dtype=dtype, ndmin=len(self.axes))
+        self.values.flags.writeable = False
+
+    def expand(self, axes):
+        """
+        The same batch over the given list of axis names, which must
+        include the axes of this batch, with unit dimensions for the
+        other axes.
+        """
+        order = sorted(range(len(self.axes)), key=lambda i: axes.index(self.axes[i]))
+        shape = [self.values.shape[self.axes.index(axis)] if axis in self.axes else 1
+                 for axis in axes]
+        return Batch(axes, self.values.transpose(order).reshape(shape),
+                     self.values.dtype)
+
+    def __len__(self):
+        return self.values.size
+
+    def __eq__(self, other):
+        return (isinstance(other, Batch) and self.axes == other.axes
+                and np.array_equal(self.values, other.values)
+                and self.values.shape == other.values.shape)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((tuple(self.axes), self.values.shape, self.values.tobytes()))
+
+    def __repr__(self):
+        return 'Batch(%r, shape=%r)' % (self.axes, self.values.shape)
+
+
+def evaluate_batch(obj, batch, **params):
+    """
+    Call obj (with the given parameter overrides) over the batched
+    parameters (name to Batch), returning the stack of results shaped
+    by the batch axes followed by the shape of a single result.
+
+    Unless the batch includes spatial parameters, obj is first called
+    once with the values of the batches as arrays (broadcasting against
+    the coordinate grids of imagen patterns). If that fails or returns
+    a result of the wrong shape, obj is called once per batch point.
+    """
+    shape = np.broadcast(*[b.values for b in batch.values()]).shape
+    names = frozenset(batch)
+    if not (names & spatial) and (type(obj), names) not in _scalar:
+        arrays = {k: b.values[..., np.newaxis, np.newaxis] for k,b in batch.items()}
+        try:
+            result = obj(**dict(params, **arrays))
+            # Stacks fed to obj broadcast against the batches
+            if (np.ndim(result) == len(shape) + 2 and
+                np.broadcast(np.empty(result.shape[:len(shape)]),
+                             np.empty(shape)).shape == result.shape[:len(shape)]):
+                return result
+        except Exception:
+            pass
+        _scalar.add((type(obj), names))
+
+    values = {k: np.broadcast_to(b.values, shape) for k,b in batch.items()}
+    result = None
+    for index in np.ndindex(*shape):
+        point = {k: v[index].item() for k,v in values.items()}
+        with at_point([tuple(i if n > 1 else None for i, n in zip(index, shape)), False]) as state:
+            value = np.asarray(obj(**dict(params, **point)))
+        if state[1]: # A stack over the axes, from stacks selected at the point
+            target = tuple(slice(i, i + 1) if n > 1 else slice(None)
+                           for i, n in zip(index, shape))
+            stack_shape = tuple(n if n > 1 else m for n, m in zip(shape, value.shape))
+        else:
+            (target, stack_shape) = (index, shape)
+        if result is None:
+            result = np.empty(stack_shape + value.shape[len(stack_shape) if state[1] else 0:],
+                              value.dtype)
+        result[target] = value
+    return result
+
+
+@contextmanager
+def at_point(state):
+    """
+    Context manager making boxflow.cache.evaluate select the part of
+    any stack over the axes at the given [index, stacked] state of a
+    batch point loop (see select), or not if state is None.
+    """
+    previous = getattr(_point, 'state', None)
+    _point.state = state
+    try:
+        yield state
+    finally:
+        _point.state = previous
+
+
+def current_point():
+    "The state of the batch point evaluated by the thread (see at_point)"
+    return getattr(_point, 'state', None)
+
+
+def select(value, state):
+    """
+    Select the part of a stack over the axes at the batch point of the
+    given state (keeping unit dimensions), so that a stack and a batch
+    over the same axis are zipped. The index of the point is None for
+    the axes the batch does not vary over, along which the stack is
+    kept whole. Other values are returned unchanged.
+    """
+    (index, _) = state
+    if not isinstance(value, np.ndarray) or value.ndim != len(index) + 2:
+        return value
+    state[1] = True
+    return value[tuple(slice(None) if i is None or n == 1 else slice(i, i + 1)
+                       for i, n in zip(index, value.shape))]
+
+
+def map_images(fn, stack):
+    "Apply fn to every image of a stack, returning the stack of results"
+    result = None
+    for index in np.ndindex(*stack.shape[:-2]):
+        image = fn(stack[index])
+        if result is None:
+            result = np.empty(stack.shape[:-2] + image.shape, image.dtype)
+        result[index] = image # Copied before fn may reuse its output buffer
+    return result
+
+
+def montage(stack, gap=1):
+    """
+    Tile a stack of images into a single contact sheet. Batch axes of
+    size one are dropped, the last remaining axis runs along the rows
+    of the sheet and the others down its columns (a single axis is
+    wrapped into a roughly square sheet).
+    """
+    sizes = [n for n in stack.shape[:-2] if n > 1]
+    if not sizes:
+        return stack.reshape(stack.shape[-2:])
+    columns = sizes[-1] if len(sizes) > 1 else int(np.ceil(np.sqrt(sizes[0])))
+    images = stack.reshape((-1,) + stack.shape[-2:])
+    rows = -(-len(images) // columns)
+    (height, width) = images.shape[1:]
+    sheet = np.empty((rows * (height + gap) - gap, columns * (width + gap) - gap),
+                     dtype=images.dtype)
+    sheet[...] = images.min()
+    for i, image in enumerate(images):
+        (row, column) = divmod(i, columns)
+        sheet[row * (height + gap):row * (height + gap) + height,
+              column * (width + gap):column * (width + gap) + width] = image
+    return sheet
@@ -0,0 +1,160 @@
+# Module offering fast isotropic Gaussian blur engines
+#
+# All engines take a 2D array and the standard deviation of the Gaussian
+# in pixels and treat the array as periodic (matching the circular
+# boundary of the FFT convolution used by interface.imagen.Convolve).
+#
+# 'fft'       : Exact convolution in the frequency domain.
+# 'separable' : Two 1D convolutions, cost proportional to sigma.
+# 'box'       : Three successive box blurs, cost independent of sigma.
+# 'pyramid'   : Downsample, blur at the coarse scale and upsample.
+#
+# The box and pyramid engines fall back to the FFT for blurs too small
+# for them to approximate.
+#
+# The 'convolve' path of the Blur box renders its kernel over 40 sigma
+# pixels, which offsets it by up to half a pixel and crops it on images
+# smaller than about 25 sigma, so engines only match it for blurs of a
+# few pixels up to a 25th of the image (see select_engine).
+#
+# See benchmarks/blur.py for the accuracy and speed of each engine.
+from __future__ import absolute_import, division
+
+import math
+import numpy as np
+
+
+def gaussian_kernel1d(sigma, truncate=4.0):
+    "Normalized 1D Gaussian kernel truncated at truncate standard deviations"
+    radius = max(int(math.ceil(truncate * sigma)), 1)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (x / max(sigma, 1e-6))**2)
+    return kernel / kernel.sum()
+
+
+def fft_blur(arr, sigma):
+    "Exact periodic Gaussian blur computed in the frequency domain"
+    rows, cols = arr.shape
+    fy = np.fft.fftfreq(rows)[:, None]
+    fx = np.fft.rfftfreq(cols)[None, :]
+    transfer = np.exp(-2 * (np.pi * sigma)**2 * (fx**2 + fy**2))
+    return np.fft.irfft2(np.fft.rfft2(arr) * transfer, s=arr.shape)
+
+
+def _wrap_rows(arr, before, after):
+    "Periodically pad the first axis"
+    return np.concatenate([arr[arr.shape[0] - before:], arr, arr[:after]])
+
+
+def _convolve_rows(arr, kernel):
+    "Periodic 1D convolution of a symmetric kernel along the first axis"
+    radius = len(kernel) // 2
+    n = arr.shape[0]
+    padded = _wrap_rows(arr, radius, radius)
+    out = kernel[radius] * arr
+    for offset in range(1, radius + 1):
+        out += kernel[radius + offset] * (padded[radius - offset:radius - offset + n]
+                                          + padded[radius + offset:radius + offset + n])
+    return out
+
+
+def separable_blur(arr, sigma):
+    "Gaussian blur as two 1D convolutions (best for small sigma)"
+    kernel = gaussian_kernel1d(sigma)
+    if len(kernel) > min(arr.shape): # Wider than the period
+        return fft_blur(arr, sigma)
+    return _convolve_rows(_convolve_rows(arr, kernel).T, kernel).T
+
+
+def box_widths(sigma, passes=3):
+    """
+    Odd box widths whose successive application approximates a Gaussian
+    of the given standard deviation.
+    """
+    ideal = math.sqrt(12 * sigma**2 / passes + 1)
+    lower = int(math.floor(ideal))
+    lower = lower - 1 if lower % 2 == 0 else lower
+    upper = lower + 2
+    m = round((12 * sigma**2 - passes * lower**2 - 4 * passes * lower
+               - 3 * passes) / (-4 * lower - 4))
+    return [lower if i < m else upper for i in range(passes)]
+
+
+def _box_rows(arr, width):
+    "Periodic running mean of odd width along the first axis"
+    radius = width // 2
+    n = arr.shape[0]
+    summed = np.cumsum(_wrap_rows(arr, radius + 1, radius), axis=0)
+    return (summed[width:width + n] - summed[:n]) / width
+
+
+def box_blur(arr, sigma, passes=3):
+    """
+    Gaussian approximated by successive box blurs (cost independent of
+    sigma). Below sigma of about 1.4 pixels some boxes would be a single
+    pixel wide (leaving the image unblurred for sigma below 0.8) so the
+    exact FFT is used instead, as for boxes wider than the image.
+    """
+    widths = box_widths(sigma, passes)
+    if min(widths) < 3 or max(widths) >= min(arr.shape):
+        return fft_blur(arr, sigma)
+    for width in widths:
+        arr = _box_rows(_box_rows(arr, width).T, width).T
+    return arr
+
+
+def _upsample1d(arr, factor, axis):
+    "Periodic linear interpolation by an integer factor along an axis"
+    n = arr.shape[axis]
+    positions = (np.arange(n * factor) + 0.5) / factor - 0.5
+    lower = np.floor(positions).astype(int)
+    frac = positions - lower
+    shape = [1] * arr.ndim
+    shape[axis] = -1
+    frac = frac.reshape(shape)
+    return ((1 - frac) * np.take(arr, lower % n, axis=axis)
+            + frac * np.take(arr, (lower + 1) % n, axis=axis))
+
+
+def pyramid_blur(arr, sigma, min_sigma=2.0):
+    """
+    Blur by averaging down by a power of two, blurring the coarse image
+    and interpolating back up (best for large sigma).
+    """
+    rows, cols = arr.shape
+    factor = 1
+    while (sigma / (factor * 2) >= min_sigma
+           and rows % (factor * 2) == 0 and cols % (factor * 2) == 0):
+        factor *= 2
+    if factor == 1:
+        return fft_blur(arr, sigma)
+    # Block averaging and linear interpolation blur by (f^2-1)/12 and
+    # (f^2-1)/6 pixels^2 respectively; the coarse blur makes up the rest.
+    residual = max(sigma**2 - (factor**2 - 1) / 4, 0)
+    coarse = arr.reshape(rows // factor, factor, cols // factor, factor).mean(axis=(1, 3))
+    coarse = separable_blur(coarse, math.sqrt(residual) / factor)
+    return _upsample1d(_upsample1d(coarse, factor, 0), factor, 1)
+
+
+engines = {'fft': fft_blur,
+           'separable': separable_blur,
+           'box': box_blur,
+           'pyramid': pyramid_blur}
+
+
+def select_engine(sigma, shape):
+    """
+    Pick a blur engine for the standard deviation in pixels and the
+    shape of the image: 'convolve' (the rendered kernel of the Blur box)
+    unless every engine matches it to within 2% of the range of the
+    image, i.e. for sigma from 4 pixels up to a 25th of the image (see
+    tests/test_blur.py). Then, according to the timings of
+    benchmarks/blur.py, the exact FFT unless the pyramid is measurably
+    faster (large blurs on large images).
+    """
+    if sigma < 4 or 25 * sigma > min(shape):
+        return 'convolve'
+    pixels = shape[0] * shape[1]
+    if (sigma >= 16 and pixels >= 256 * 256) or (sigma >= 8 and pixels >= 512 * 512):
+        return 'pyramid'
+    return 'fft'
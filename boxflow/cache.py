@@ -0,0 +1,234 @@
+# Module offering memoization of box evaluation results
+from __future__ import absolute_import
+import types
+import random
+import hashlib
+import threading
+import functools
+import fractions
+from contextlib import contextmanager
+from collections import OrderedDict
+
+import param
+import numpy as np
+
+from . import profiling
+from . import batching
+
+
+class EvaluationCache(object):
+    """
+    Least-recently-used cache of box evaluation results bounded by a
+    byte budget. Results are stored under keys computed by the DataFlow
+    from the parameter state of a box and the versions of its inputs.
+
+    The cache may be shared between threads evaluating boxes concurrently.
+
+    If keep_stale is False, the DataFlow discards the entry of a box as
+    soon as its key changes, as needed when boxes write into reused
+    buffers (see boxflow.memory.BufferPool).
+    """
+
+    def __init__(self, max_bytes=256 * 1024**2, keep_stale=True):
+        self.max_bytes = max_bytes
+        self.keep_stale = keep_stale
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # Key to (value, nbytes)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def sizeof(cls, value):
+        "Estimate of the number of bytes held by a cached value"
+        if hasattr(value, 'nbytes'):
+            return value.nbytes
+        elif isinstance(value, (str, bytes)):
+            return len(value)
+        elif isinstance(value, dict):
+            return sum(cls.sizeof(v) for v in value.values())
+        return 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            value, nbytes = self._entries.pop(key)
+            self._entries[key] = (value, nbytes) # Mark as most recently used
+            return value
+
+    def put(self, key, value):
+        nbytes = self.sizeof(value)
+        if hasattr(value, 'flags'): # Cached arrays are shared, not copied
+            value.flags.writeable = False
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if nbytes > self.max_bytes:
+                return  # Never worth evicting everything for one result
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.nbytes -= evicted
+
+    def discard(self, key):
+        "Discard the entry for key along with its overridden variants"
+        with self._lock:
+            for k in [k for k in self._entries
+                      if k == key or (isinstance(k, tuple) and len(k) == 2
+                                      and k[0] == key)]:
+                self.nbytes -= self._entries.pop(k)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+# Coordinate grids shared by all the patterns of the process, keyed by
+# bounds, density, position and orientation (None to disable)
+grids = EvaluationCache(64 * 1024**2)
+
+
+
+def hashable(value, content=False):
+    """
+    Convert a parameter value to a hashable representation. Parameterized
+    objects are represented by identity as their state is tracked
+    separately through box versions, or by content (see content_state)
+    if content is set.
+    """
+    if isinstance(value, param.Parameterized):
+        return content_state(value) if content else ('id', id(value))
+    elif isinstance(value, (list, tuple)):
+        return tuple(hashable(v, content) for v in value)
+    elif isinstance(value, dict):
+        return tuple(sorted((k, hashable(v, content)) for k,v in value.items()))
+    elif content:
+        return _content(value)
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return ('id', id(value))
+
+
+def _content(value):
+    """
+    Hashable representation of a value other than a Parameterized object
+    or a container by content, with a deterministic repr (see digest).
+    Values of unknown types without a value of their own are
+    represented by identity.
+    """
+    if value is None or isinstance(value, (bool, int, float, complex,
+                                           fractions.Fraction, str, bytes)):
+        return value
+    elif isinstance(value, batching.Batch):
+        return ('Batch', tuple(value.axes), _content(value.values))
+    elif isinstance(value, np.ndarray):
+        arr = np.ascontiguousarray(value)
+        return ('array', arr.shape, arr.dtype.str, hashlib.sha1(arr.data).hexdigest())
+    elif hasattr(value, 'lbrt'): # e.g. the bounds of imagen patterns
+        return (type(value).__name__, tuple(float(v) for v in value.lbrt()))
+    elif isinstance(value, random.Random):
+        return ('Random', digest(value.getstate()))
+    elif isinstance(value, np.random.RandomState):
+        return ('RandomState', digest(value.get_state()))
+    elif isinstance(value, (type, types.FunctionType, types.BuiltinFunctionType)):
+        return (type(value).__name__, value.__module__, value.__name__)
+    return ('id', id(value))
+
+
+def digest(value):
+    "Fixed size digest of the repr of a (content) hashable representation"
+    return hashlib.sha1(repr(value).encode('utf8')).hexdigest()
+
+
+def content_state(obj, excluded=[]):
+    """
+    Hashable representation of a Parameterized object by its type and
+    parameter values (other than the excluded ones), identifying equal
+    objects of different DataFlows. The name is left out unless the
+    object is time dependent: random streams are then seeded from the
+    name and param.random_seed (both included) and the random generator
+    (reseeded whenever called) is left out.
+    """
+    excluded = set(excluded) | {'name'}
+    seeded = ()
+    if getattr(obj, 'time_dependent', False):
+        excluded.add('random_generator')
+        seeded = (obj.name, param.random_seed)
+    values = [(k, hashable(v, content=True)) for k,v in obj.get_param_values()
+              if k not in excluded]
+    return (type(obj),) + seeded + (tuple(values),)
+
+
+_context = threading.local()
+
+@contextmanager
+def overrides(**params):
+    """
+    Context manager supplying parameter overrides (e.g. a lower xdensity
+    and ydensity for a preview) to every call made by evaluate in the
+    current thread. Overridden results are memoized separately.
+    """
+    previous = getattr(_context, 'params', {})
+    _context.params = dict(previous, **params)
+    try:
+        yield
+    finally:
+        _context.params = previous
+
+
+def evaluate(obj):
+    """
+    Call obj (typically a PatternGenerator) with the current overrides,
+    returning the result memoized by the DataFlow holding the
+    corresponding box if one is available. Memoized arrays are read-only
+    and must be copied before being modified in place.
+
+    A result is only memoized if the box was not modified while it was
+    being computed (e.g. by the IOLoop while evaluating in a worker) and
+    memoized results of a time dependent box are only used at the time
+    its key was computed for.
+
+    The fused kernel of the box is called instead of obj if one was
+    compiled (see boxflow.fusion). Boxes fed batches of parameter
+    values evaluate to stacks (see boxflow.batching), of which only the
+    part at the current point is returned while a downstream box is
+    evaluated point by point.
+    """
+    point = batching.current_point()
+    if point is not None: # Within the batch point loop of a downstream box
+        with batching.at_point(None):
+            value = evaluate(obj)
+        return batching.select(value, point)
+    params = getattr(_context, 'params', {})
+    fn = getattr(obj, '_boxflow_fused', None) or obj
+    batch = getattr(obj, '_boxflow_batch', None)
+    if batch:
+        fn = functools.partial(batching.evaluate_batch, obj, batch)
+    memo = getattr(obj, '_boxflow_memo', None)
+    if memo is None:
+        return fn(**params)
+    cache, key, time = memo
+    if time is not None and time != param.Dynamic.time_fn():
+        return fn(**params) # The key is out of date
+    if params:
+        key = (key, tuple(sorted(params.items())))
+    result = cache.get(key)
+    if result is None:
+        with profiling.stage('evaluate', getattr(obj, 'name', None)):
+            result = fn(**params)
+        if getattr(obj, '_boxflow_memo', None) is memo:
+            cache.put(key, result)
+    return result
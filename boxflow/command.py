@@ -1,29 +1,154 @@
-import json
+from functools import partial, wraps
+from collections import OrderedDict
+from concurrent.futures import wait
 
 from .dataflow import DataFlow
+from .cache import EvaluationCache
+from .transport import encode_message, digest
+from .playback import Playback
+from .session import Session
+from . import graph
+from . import memory
+from . import profiling
 try: # pip install pyperclip
     import pyperclip
 except:
     pyperclip = None
 
+
+def activated(method):
+    """
+    Decorator running a Command method within the session of the Command.
+    On the IOLoop, the call is queued (see Session.run) if another
+    session is active so the method returns None.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.loop is None:
+            with self.session.activate():
+                return method(self, *args, **kwargs)
+        self.session.run(self.loop, partial(method, self, *args, **kwargs))
+    return wrapper
+
+
 class Command(object):
     """
     The Command class links the messages sent of the websocket to the
     associated operations on the dataflow graph.
+
+    If an executor (e.g. a ThreadPoolExecutor) and IOLoop are supplied,
+    boxes are displayed in the worker pool and the resulting messages
+    are written back through the IOLoop. Otherwise boxes are displayed
+    synchronously.
+
+    With an IOLoop, update_params messages (e.g. sent while dragging a
+    slider) are coalesced: updates to the same box received within the
+    latency target (in seconds) or while displays are still in flight
+    are merged and only the latest values are evaluated.
+
+    Images are sent using the given transport ('json', 'raw' or 'png')
+    as described in boxflow.transport. An image_update identical to the
+    last one sent for the same box is not sent again.
+
+    If preview is set (and an IOLoop is supplied), image boxes whose
+    display size was reported by the client are first displayed as low
+    resolution previews at that size. Viewport boxes are then displayed
+    at full resolution as soon as no updates are pending while all other
+    boxes are only displayed at full resolution once no updates have
+    been received for idle seconds.
+
+    Time boxes (with a true playback attribute) may be played back over
+    a number of time steps: frames are rendered in batches (in a worker
+    if an executor is supplied) and streamed to the client at the
+    requested frame rate. Messages received while a batch is rendered
+    in a worker are dispatched once it is done.
+
+    If track_memory is set, the peak number of bytes allocated while
+    updating and displaying the graph is recorded in memory_peaks for
+    every parameter update (only complete if boxes are displayed
+    synchronously).
+
+    Boxes are evaluated within the Session (time and random seed) of
+    the Command. If a cache is supplied, it is shared with the other
+    Commands given the same cache so that identical subgraphs are only
+    evaluated once (see DataFlow). If fuse is set, elementwise imagen
+    subgraphs are evaluated as fused kernels (see boxflow.fusion).
     """
 
-    def __init__(self, handler, inventory, excluded):
+    def __init__(self, handler, inventory, excluded,
+                 cache_bytes=256 * 1024**2, executor=None, loop=None,
+                 latency=0.05, transport='json', compress_level=1,
+                 track_memory=False, preview=True, idle=0.5,
+                 session=None, cache=None, fuse=False):
         self.inventory = inventory
         self.handler = handler
         self.excluded = excluded
+        self.executor = executor
+        self.loop = loop
+        self.latency = latency
+        self.transport = transport
+        self.compress_level = compress_level
+        self.track_memory = track_memory
+        self.memory_peaks = []
+        self.preview = preview
+        self.idle = idle
+        self.display_sizes = {} # Box name to (width, height) on the client
+
+        self.session = Session() if session is None else session
+        if cache is not None:
+            self.dataflow = DataFlow(cache=cache, shared=True, fuse=fuse)
+        else: # Pooled buffers are overwritten so stale cache entries must go
+            cache = EvaluationCache(cache_bytes, keep_stale=memory.pool is None)
+            self.dataflow = DataFlow(cache=cache, fuse=fuse)
+        self._submitted = {} # Box name to sequence number of latest display
+        self._sent = {}      # Box name to sequence number of last message
+        self._futures = {}   # Box name to future of latest display
+        self._inflight = 0   # Number of displays submitted but not handled
+        self._digests = {}   # Box name to digest of last image_update sent
 
-        self.dataflow = DataFlow()
+        self._pending = OrderedDict() # Box name to merged pending params
+        self._flush_handle = None
+        self._last_flush = None
+
+        self._full = OrderedDict() # Previewed box name to whether a viewport
+        self._full_handle = None
+        self._last_update = None   # IOLoop time of the last parameter update
+
+        self._playback = None
+        self._playback_handle = None
+        self._rendering = None # Future of the batch of frames rendered in a worker
+        self._queued = []      # Messages received while rendering
 
     def send(self, command, data):
-        self.handler.write_message(
-            json.dumps({'command':command, 'data':data}))
+        self.write(*self.encode(command, data))
+
+    def encode(self, command, data):
+        name = data['name'] if command == 'image_update' else None
+        with profiling.stage('encode:' + self.transport, name) as info:
+            message, binary = encode_message(command, data,
+                                             self.transport, self.compress_level)
+            info['bytes'] = len(message)
+        return message, binary
+
+    def write(self, message, binary=False):
+        with profiling.stage('send') as info:
+            self.handler.write_message(message, binary=binary)
+            info['bytes'] = len(message)
 
+    @activated
     def dispatch(self, json):
+        if self._rendering is not None: # The worker is updating the graph
+            self._queued.append(json)
+            return
+        with profiling.stage('dispatch:' + json['command']):
+            self._dispatch(json)
+
+    def _dispatch(self, json):
+        if json['command'] == 'update_params':
+            self.coalesce_params(json['data'])
+            return
+        self.flush() # Apply pending updates before any other command
+
         if json['command'] == 'add_node':
             self.add_node(json['data'])
         if json['command'] == 'remove_node':
@@ -33,12 +158,20 @@ class Command(object):
             self.add_edge(json['data'])
         if json['command'] == 'remove_edge':
             self.remove_edge(json['data'])
-        if json['command'] == 'update_params':
-            self.update_params(json['data'])
         if json['command'] == 'trigger_button':
             self.trigger_button(json['data'])
         if json['command'] == 'node_repr':
             self.node_repr(json['data'])
+        if json['command'] == 'display_size':
+            self.display_size(json['data'])
+        if json['command'] == 'load_graph':
+            self.load_graph(json['data'])
+        if json['command'] == 'save_graph':
+            self.save_graph(json['data'])
+        if json['command'] == 'play':
+            self.play(json['data'])
+        if json['command'] == 'stop':
+            self.stop()
 
     # Receive commands
 
@@ -62,16 +195,60 @@ class Command(object):
         else:
             print('Please pip install pyperclip')
 
+    def load_graph(self, data):
+        """
+        Replace the graph by the given graph document (e.g. to restore
+        the session of a reconnecting client) in a single operation,
+        displaying every box once the whole graph is in place.
+        """
+        self.stop()
+        for name in list(self.dataflow.boxes):
+            self.remove_node({'name':name})
+        for spec in data['boxes']:
+            if spec.get('display_size'):
+                self.display_sizes[spec['name']] = tuple(spec['display_size'])
+        _, ordered = graph.import_graph(data, self.inventory, self.dataflow)
+        self.display(ordered)
+
+    def save_graph(self, data):
+        """
+        Save the graph document (e.g. for boxflow-batch) as JSON to
+        boxflow-graph.json in the working directory of the server. The
+        file name is fixed as any web page may send this message.
+        """
+        try:
+            graph.save(self.dataflow, 'boxflow-graph.json')
+        except Exception as e:
+            print('Warning (save_graph): Could not save graph (%s)' % e)
+            return
+        print('Saved graph to boxflow-graph.json')
+
     def add_node(self, data):
-        # TODO: Assuming class names unique between groups
+        # Type names may be qualified by group if not unique between groups
         boxtype = self.inventory.lookup_boxtype(data['type'])
         box = boxtype(self.inventory, name=data['name'], **data['params'])
+        if data.get('display_size'):
+            self.display_sizes[data['name']] = tuple(data['display_size'])
         self.dataflow.add_box(box)
-        self.send('image_update',
-                  dict(box.display(), name=data['name']))
+        self._digests.pop(data['name'], None)
+        self.display([data['name']])
 
     def remove_node(self, data):
+        if self._playback and self._playback.name == data['name']:
+            self.stop()
         self.dataflow.remove_box(data['name'])
+        self._digests.pop(data['name'], None)
+        self.display_sizes.pop(data['name'], None)
+        self._full.pop(data['name'], None)
+
+    def display_size(self, data):
+        "Record the size of a box on the client, redisplaying if previewed"
+        size = (data['width'], data['height'])
+        if self.display_sizes.get(data['name']) == size:
+            return
+        self.display_sizes[data['name']] = size
+        if data['name'] in self._full:
+            self.display([data['name']])
 
     def add_edge(self, data):
         (s,o,d,i) =(data['src'], data['output'], data['dest'], data['input'])
@@ -91,27 +268,325 @@ class Command(object):
 
 
     def update_params(self, data):
-        updated = self.dataflow.update_params(data['name'], data['params'])
+        if self._playback and self._playback.name == data['name']:
+            self.stop() # Time set by the user
+        elif self._playback:
+            self._playback.clear() # Buffered frames are out of date
+        if self.loop is not None:
+            self._last_update = self.loop.time()
+        with memory.peak_memory(self.track_memory) as usage:
+            updated = self.dataflow.update_params(data['name'], data['params'])
+            self.display(updated)
+        if usage:
+            self.memory_peaks.append(usage['peak'])
+            print('Peak memory updating %r: %.1f MB'
+                  % (data['name'], usage['peak'] / 1024.0**2))
 
-        for name in updated:
-            box = self.dataflow.find_box(name)
-            if box:
-                self.send('image_update',
-                          dict(box.display(), name=name))
+    def coalesce_params(self, data):
+        """
+        Queue a parameter update to be merged with any other pending
+        updates to the same box and applied by flush, either once the
+        latency target has elapsed since the last flush or once the
+        displays in flight are done (whichever is later).
+        """
+        if self.loop is None:
+            self.update_params(data)
+            return
+        self._pending.setdefault(data['name'], {}).update(data['params'])
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if (self._flush_handle is not None or self._inflight
+            or self._rendering is not None or not self._pending):
+            return
+        now = self.loop.time()
+        delay = (0 if self._last_flush is None
+                 else max(0, self._last_flush + self.latency - now))
+        self._flush_handle = self.loop.call_later(delay, self.flush)
+
+    @activated
+    def flush(self):
+        "Apply all pending parameter updates."
+        if self._flush_handle is not None:
+            self.loop.remove_timeout(self._flush_handle)
+            self._flush_handle = None
+        if not self._pending or self._rendering is not None:
+            return # Rescheduled once the frames are rendered
+        self._last_flush = self.loop.time()
+        pending, self._pending = self._pending, OrderedDict()
+        for name, params in pending.items():
+            self.update_params({'name':name, 'params':params})
 
     def trigger_button(self, data):
         box = self.dataflow.find_box(data['name'])
         if box is None: return
+        if getattr(box.instance, 'playback', False):
+            if data['button'] == 'play':
+                self.play({'name':data['name']})
+                return
+            elif data['button'] == 'stop':
+                self.stop()
+                return
+            self.stop()
         # Push updated values to the GUI
         params = box.trigger(data['button'])
         self.push_params(data['name'], params)
         self.update_params({'name':data['name'], 'params':params})
 
+    # Playback
+
+    def play(self, data):
+        """
+        Play back the named time box over the given number of frames at
+        the given frame rate (defaulting to the parameters of the box).
+        Without an IOLoop, all the frames are sent immediately.
+        """
+        self.stop()
+        box = self.dataflow.find_box(data['name'])
+        if box is None: return
+        playback = Playback(self, data['name'],
+                            data.get('frames', box['frames']),
+                            data.get('fps', box['fps']),
+                            data.get('batch', 8))
+        if self.loop is None:
+            while playback.rendered < len(playback.times):
+                playback.render()
+                while playback.buffered:
+                    self._send_frame(playback.name, *playback.buffered.popleft())
+            return
+        self._playback = playback
+        self._playback_start = self.loop.time()
+        self._playback_sent = 0
+        self._playback_time = box['time'] # Time of the last frame sent
+        self._next_frame()
+
+    @activated
+    def _next_frame(self):
+        "Send the next frame, rendering a batch whenever the buffer is empty"
+        self._playback_handle = None
+        playback = self._playback
+        if not playback.buffered:
+            if self.executor is not None:
+                self._rendering = self.executor.submit(self._render, playback)
+                self._rendering.add_done_callback(self._rendered)
+                return
+            playback.render()
+        if playback.buffered:
+            self._playback_time = playback.buffered[0][0]
+            self._send_frame(playback.name, *playback.buffered.popleft())
+            self._playback_sent += 1
+        if playback.done:
+            self._playback = None
+            self._schedule_full()
+            return
+        deadline = self._playback_start + self._playback_sent / float(playback.fps)
+        self._playback_handle = self.loop.call_at(deadline, self._next_frame)
+
+    def _render(self, playback):
+        "Render the next batch of frames in a worker"
+        with self.session.activate():
+            playback.render()
+
+    def _rendered(self, future):
+        "Called from the worker to hand the frames back to the IOLoop"
+        self.loop.add_callback(self._resume_playback, future)
+
+    def _resume_playback(self, future):
+        """
+        Send the first frame rendered in the worker and dispatch the
+        messages received in the meantime.
+        """
+        self._rendering = None
+        if future.exception() is not None:
+            print('Warning (play): Rendering frames raised %r' % future.exception())
+            self.stop()
+        elif self._playback is not None:
+            self._next_frame()
+        queued, self._queued = self._queued, []
+        for json in queued:
+            self.dispatch(json)
+        self._schedule_flush()
+
+    def _send_frame(self, name, time, frame):
+        for (box_name, display_digest, message, binary) in frame:
+            # Displays still in flight are superseded by the frame
+            self._submitted[box_name] = self._submitted.get(box_name, 0) + 1
+            self._write_display(box_name, display_digest, message, binary)
+        self.push_params(name, {'time':float(time)})
+
+    def stop(self):
+        """
+        Stop playback, leaving the graph at the time of the last frame
+        sent to the client.
+        """
+        if self._playback is None:
+            return
+        if self._playback_handle is not None:
+            self.loop.remove_timeout(self._playback_handle)
+            self._playback_handle = None
+        playback, self._playback = self._playback, None
+        if playback.buffered: # The graph is ahead of the client
+            self.update_params({'name':playback.name,
+                                'params':{'time':self._playback_time}})
+        self._schedule_full()
+
+    # Display boxes
+
+    def display(self, names, full=False):
+        """
+        Send an image_update for each of the named boxes (given in
+        topological order). With an executor, each box is displayed in
+        a worker once the boxes in names that feed into it are done so
+        that independent branches are evaluated concurrently.
+
+        Unless full is set, boxes are displayed as previews if possible
+        (see preview_overrides) and scheduled for a full resolution pass.
+        """
+        if self.executor is None:
+            for name in names:
+                box = self.dataflow.find_box(name)
+                if box:
+                    overrides = {} if full else self.preview_overrides(box)
+                    self._write_display(name, *self._display(box, [], overrides))
+            self._schedule_full()
+            return
+
+        futures = {}
+        for name in names:
+            box = self.dataflow.find_box(name)
+            if box is None: continue
+            upstream = [futures[s] for (s,o,d,i) in self.dataflow.inlinks(box)
+                        if s in futures]
+            sequence = self._submitted.get(name, 0) + 1
+            self._submitted[name] = sequence
+            if name in self._futures:
+                self._futures[name].cancel() # Superseded if not yet started
+            overrides = {} if full else self.preview_overrides(box)
+            future = self.executor.submit(self._display, box, upstream, overrides)
+            self._inflight += 1
+            future.add_done_callback(partial(self._displayed, name, sequence))
+            futures[name] = future
+            self._futures[name] = future
+        self._schedule_full()
+
+    def preview_overrides(self, box):
+        """
+        Overrides rendering a preview of the box at its display size,
+        marking the box for a later full resolution pass. Previews are
+        only used with an IOLoop to schedule the full resolution pass.
+        """
+        size = self.display_sizes.get(box.name)
+        if not self.preview or self.loop is None or size is None:
+            return {}
+        overrides = box.preview_overrides(*size)
+        if overrides:
+            self._full[box.name] = box.boxtype.nodetype == 'Viewport'
+        return overrides
+
+    def _schedule_full(self):
+        """
+        Schedule the full resolution pass: immediately for viewports and
+        once no updates have been received for the idle period otherwise.
+        """
+        if not self._full:
+            return
+        if self._full_handle is not None:
+            self.loop.remove_timeout(self._full_handle)
+        delay = 0 if any(self._full.values()) else self.idle
+        self._full_handle = self.loop.call_later(delay, self.display_full)
+
+    @activated
+    def display_full(self):
+        """
+        Display previewed boxes at full resolution once no updates are
+        pending or in flight: viewports first and all the other boxes
+        once the user has been idle.
+        """
+        self._full_handle = None
+        if self._pending or self._inflight or self._playback:
+            return # Rescheduled once the displays in flight are done
+        idle = (self._last_update is None
+                or self.loop.time() - self._last_update >= self.idle)
+        names = [name for name, viewport in self._full.items()
+                 if viewport or idle]
+        for name in names:
+            del self._full[name]
+        downstream = {name:self.dataflow.downstream(name) for name in names}
+        # Boxes follow every box upstream of them in names
+        depth = lambda n: sum(n in downstream[name] for name in names)
+        self.display(sorted(names, key=depth), full=True)
+
+    def _display(self, box, upstream, overrides={}):
+        """
+        Display and encode the box (in a worker) after its upstream boxes
+        are done, returning a (digest, message, binary) tuple. Encoding is
+        skipped (message is None) if the display is unchanged.
+        """
+        wait(upstream)
+        with self.session.activate():
+            display = dict(box.display(overrides), name=box.name)
+            # Pooled buffers are not reused by other workers until encoded
+            held = memory.hold(display.values())
+        try:
+            display_digest = digest(display)
+            if display_digest == self._digests.get(box.name):
+                return display_digest, None, False
+            return (display_digest,) + self.encode('image_update', display)
+        finally:
+            memory.unhold(held)
+
+    def _write_display(self, name, display_digest, message, binary):
+        "Write the encoded display unless identical to the last one sent"
+        if message is None or display_digest == self._digests.get(name):
+            return
+        self._digests[name] = display_digest
+        self.write(message, binary)
+        if profiling.profiler is not None: # For the overlay on the client
+            self.send('box_stats', {'name':name,
+                                    'stats':profiling.profiler.box_stats(name)})
+
+    def _displayed(self, name, sequence, future):
+        "Called from the worker to hand the result back to the IOLoop"
+        self.loop.add_callback(self._send_display, name, sequence, future)
+
+    def _send_display(self, name, sequence, future):
+        """
+        Send the result of a display on the IOLoop, dropping results
+        superseded by a more recent display of the same box so that
+        stale images are never sent and per-box ordering is preserved.
+        """
+        self._inflight -= 1
+        if self._futures.get(name) is future:
+            del self._futures[name]
+        self._schedule_flush()
+        if not self._inflight and not self._pending:
+            self._schedule_full()
+
+        if future.cancelled() or sequence < self._submitted.get(name, 0):
+            return
+        if sequence <= self._sent.get(name, 0):
+            return
+        self._sent[name] = sequence
+        if future.exception() is not None:
+            print('Warning (display): Box %r raised %r'
+                  % (name, future.exception()))
+        else:
+            self._write_display(name, *future.result())
+
     # Push commands
 
-    def push_definitions(self):
-        definitions = self.inventory.json(self.excluded, 'datgui')
-        self.send('definitions', definitions)
+    def push_definitions(self, etag=None):
+        """
+        Push the (shared, pre-serialized) definitions to the frontend. If
+        the client already holds definitions with the current etag, only
+        the etag is sent so that the client reuses its stored copy.
+        """
+        current, definitions = self.inventory.serialized(self.excluded, 'datgui')
+        if etag == current:
+            self.send('definitions_unchanged', current)
+        else:
+            self.write('{"command": "definitions", "etag": "%s", "data": %s}'
+                       % (current, definitions))
 
     def push_params(self, name, params):
         " Push updated parameter values to the frontend "
@@ -1,28 +1,142 @@
 # Module handling the dataflow structure
+from collections import OrderedDict
+
+import param
+
+from . import profiling
+from . import fusion
+from .batching import Batch
+from .cache import digest
 
 
 class DataFlow(object):
     """
     The DataFlow object represents a dataflow graph consisting of links
     between boxes.
+
+    Boxes are indexed by name and links are indexed by both their
+    source and destination box names so that lookups and adjacency
+    queries do not need to scan the whole graph.
+
+    If an EvaluationCache is supplied, box results are memoized under a
+    key built from the parameter state of each box and the versions of
+    the boxes feeding into it.
+
+    If shared is set, keys are digests of the content of each box (see
+    Box.state) and of the keys of the boxes feeding into it instead of
+    box names and versions, so that identical subgraphs of different
+    DataFlows (e.g. of sessions viewing the same document) have equal
+    keys and may share one cache.
+
+    If fuse is set, elementwise subgraphs are compiled into fused
+    kernels (see boxflow.fusion) whenever the structure of the graph
+    changes so that parameter changes only re-run the kernels.
+
+    Boxes declaring batch_axes (such as the Sweep and Grid boxes of
+    interface.param) propagate Batch values, which are expanded to the
+    axes of the whole graph so that boxes fed several batches evaluate
+    over their Cartesian product (see boxflow.batching).
     """
 
-    def __init__(self):
-        self.boxes = []
-        self.links = set()
+    def __init__(self, cache=None, shared=False, fuse=False):
+        self.cache = cache
+        self.shared = shared
+        self.fuse = fuse
+        self.axes = []             # Names of the batch axes of the graph
+        self.time = param.Dynamic.time_fn() # Time of the keys of timed boxes
+        self.boxes = OrderedDict() # Box name to box
+        self._inlinks = {}         # Box name to set of incoming links
+        self._outlinks = {}        # Box name to set of outgoing links
+
+    @property
+    def links(self):
+        "The set of all (src, output, dest, input) links in the graph"
+        return set().union(*self._outlinks.values())
 
     def add_box(self, box):
-        self.boxes.append(box)
+        self.boxes[box.name] = box
+        self._inlinks.setdefault(box.name, set())
+        self._outlinks.setdefault(box.name, set())
+        self._refresh(box)
+        self._update_axes(box)
+        self._compile()
+
+    def add_graph(self, boxes, links):
+        """
+        Add the given boxes and (src, output, dest, input) links in one
+        operation. Linked parameters are set and every box is refreshed
+        once in topological order after all the links are in place,
+        returning the names of all the boxes in that order.
+        """
+        for box in boxes:
+            self.boxes[box.name] = box
+            self._inlinks.setdefault(box.name, set())
+            self._outlinks.setdefault(box.name, set())
+        for link in links:
+            (src, output, dest, input) = link
+            self._outlinks[src].add(link)
+            self._inlinks[dest].add(link)
+        self.axes = self._batch_axes()
+        ordered = self._propagate_all()
+        self._compile()
+        return ordered
+
+    def _propagate_all(self):
+        """
+        Set all the linked parameters and refresh every box once in
+        topological order, returning the names of the boxes in that order.
+        """
+        ordered = self.topological_order()
+        self.time = param.Dynamic.time_fn()
+        for name in ordered:
+            box = self.find_box(name)
+            for (s,o,d,i) in self.inlinks(box):
+                box.set_param(**{i:self._propagate(s, o)})
+            self._refresh(box)
+        return ordered
+
+    def _propagate(self, src, output):
+        "The value of the named box output, with batches expanded to the axes"
+        value = self.find_box(src).propagate(output)
+        return value.expand(self.axes) if isinstance(value, Batch) else value
+
+    def _batch_axes(self):
+        return [axis for box in self.boxes.values()
+                for axis in getattr(box.instance, 'batch_axes', [])]
+
+    def _update_axes(self, box):
+        """
+        Expand all the batches again if the axes change as the given box
+        is added or removed, which only boxes declaring axes can do.
+        """
+        if not getattr(box.instance, 'batch_axes', None):
+            return
+        axes = self._batch_axes()
+        if axes != self.axes:
+            self.axes = axes
+            self._propagate_all()
 
     def remove_box(self, name):
-        self.boxes.remove(self.find_box(name))
+        for link in list(self._inlinks.get(name, [])):
+            self.remove_link(*link)
+        for link in list(self._outlinks.get(name, [])):
+            self.remove_link(*link)
+        box = self.boxes.pop(name, None)
+        self._inlinks.pop(name, None)
+        self._outlinks.pop(name, None)
+        if box:
+            self._update_axes(box)
+        self._compile()
 
     def add_link(self, src, output, dest, input):
-        self.links.add((src, output, dest, input))
+        link = (src, output, dest, input)
+        self._outlinks.setdefault(src, set()).add(link)
+        self._inlinks.setdefault(dest, set()).add(link)
         # Set the dest parameter to the value of the source parameter
-        src_box = self.find_box(src)
         dest_box = self.find_box(dest)
-        dest_box.set_param(**{input: src_box.propagate()})
+        dest_box.set_param(**{input: self._propagate(src, output)})
+        self._refresh(dest_box)
+        self._compile()
 
 
     def allowed_link(self, src, output, dest, input):
@@ -30,10 +144,12 @@ class DataFlow(object):
         Predicate to see if the proposed connection is valid (i.e
         accepted by param).
         """
+        if self._creates_cycle(src, dest):
+            return False
         src = self.find_box(src)
         dest = self.find_box(dest)
         try:
-            dest.set_param(**{input: src.propagate()})
+            dest.set_param(**{input: src.propagate(output)})
             dest.set_param(**{input: dest[input]})
             return True
         except:
@@ -41,21 +157,51 @@ class DataFlow(object):
 
 
     def remove_link(self, src, output, dest, input):
-        self.links.remove((src, output, dest, input))
+        link = (src, output, dest, input)
+        if link not in self._inlinks.get(dest, ()):
+            # Already dropped e.g. when one of its boxes was removed
+            return
+        self._outlinks[src].remove(link)
+        self._inlinks[dest].remove(link)
         box = self.find_box(dest)
         if box:
             # Set the dest parameter back to default
             parameter = box.params()[input]
             box.set_param(**{input : parameter.default})
+            self._refresh(box)
         else:
             print('Warning (remove_link): Could not find box %r' % dest)
+        self._compile()
+
+    def _compile(self):
+        "Recompile the fused kernels after a structural change"
+        if self.fuse:
+            fusion.compile(self)
+
+
+    def _creates_cycle(self, src, dest):
+        """
+        Predicate that is True if a link from src to dest would close a
+        cycle i.e. if src is already reachable from dest.
+        """
+        return src == dest or src in self.downstream(dest)
 
 
     def update_params(self, name, params):
+        """
+        Set the given parameters on the named box and propagate the
+        change downstream, returning the names of all updated boxes in
+        topological order. Each box is updated exactly once, except for
+        boxes depending on the time if the update changed the time (see
+        refresh_time), which are listed again at the end.
+        """
         box = self.find_box(name)
         if box:
-            box.set_param(**params)
-            return [name] + self._update_downstream(box)
+            with profiling.stage('update_params', name):
+                box.set_param(**params)
+                self._refresh(box)
+                updated = [name] + self._update_downstream(box)
+                return updated + [n for n in self.refresh_time() if n not in updated]
         else:
             print('Warning (update_params): Could not find box %r' % name)
             return [name]
@@ -63,25 +209,115 @@ class DataFlow(object):
     def _update_downstream(self, box):
         """
         Co-routine of update_params that takes a box and updates
-        downstream boxes, returning a list of names for all the updated
-        boxes.
+        downstream boxes in a single topologically sorted pass,
+        returning a list of names for all the updated boxes.
+        """
+        ordered = self.topological_order(box.name)[1:]
+        for name in ordered:
+            dest = self.find_box(name)
+            for (s,o,d,i) in self.inlinks(dest):
+                dest.set_param(**{i:self._propagate(s, o)})
+            self._refresh(dest)
+        return ordered
+
+    def refresh_time(self):
+        """
+        If the time changed since the keys of the boxes depending on it
+        were computed, refresh these boxes (the time dependent boxes and
+        the boxes downstream of them) and return their names in
+        topological order.
+        """
+        if param.Dynamic.time_fn() == self.time:
+            return []
+        self.time = param.Dynamic.time_fn()
+        ordered = [name for name in self.topological_order()
+                   if self.boxes[name].timed or self.boxes[name].time_dependent()]
+        for name in ordered:
+            box = self.find_box(name)
+            for (s,o,d,i) in self.inlinks(box):
+                box.set_param(**{i:self._propagate(s, o)})
+            self._refresh(box)
+        return ordered
+
+    def _refresh(self, box):
         """
-        updated_names = []
-        outlinks = self.outlinks(box)
-        for (s,o,d,i) in outlinks:
-            # Not using output name properly...
-            updated_names += self.update_params(d, {i:box.propagate()})
-        return updated_names
+        Recompute the evaluation key of a box from its own parameter
+        state and the versions of its inputs, bumping the box version
+        whenever the key changes. The keys of time dependent boxes and
+        of the boxes downstream of them (timed boxes) include the time.
+        """
+        inlinks = [(s,i) for (s,o,d,i) in self.inlinks(box) if s in self.boxes]
+        box.timed = (box.time_dependent()
+                     or any(self.boxes[s].timed for (s,i) in inlinks))
+        time = param.Dynamic.time_fn() if box.timed else None
+        if self.shared: # Linked values are identified by their upstream keys
+            upstream = tuple(sorted((i, self.boxes[s].key) for (s,i) in inlinks))
+            state = box.state(excluded=[i for (s,i) in inlinks], content=True)
+            key = digest((state, upstream, time)) # Independent of the depth
+        else:
+            upstream = tuple(sorted((i, self.boxes[s].version) for (s,i) in inlinks))
+            key = (box.name, box.state(), upstream, time)
+        if key != box.key:
+            if self.cache is not None and not self.cache.keep_stale:
+                self.cache.discard(box.key)
+            box.key = key
+            box.version += 1
+        if self.cache is not None:
+            box.memoize(self.cache, key, time)
+
+    def downstream(self, name):
+        """
+        Return the set of names of all boxes reachable from the named box.
+        """
+        reached, frontier = set(), [name]
+        while frontier:
+            box = self.find_box(frontier.pop())
+            if box is None: continue
+            for (s,o,d,i) in self.outlinks(box):
+                if d not in reached:
+                    reached.add(d)
+                    frontier.append(d)
+        return reached
+
+    def topological_order(self, name=None):
+        """
+        Return the names of the named box and all boxes downstream of it
+        in topological order (Kahn's algorithm over the affected subgraph)
+        or the names of all the boxes if name is None.
+        """
+        if name is None:
+            affected = set(self.boxes)
+        else:
+            affected = self.downstream(name) | {name}
+        indegree = {n:0 for n in affected}
+        for n in affected:
+            box = self.find_box(n)
+            if box is None: continue
+            for (s,o,d,i) in self.outlinks(box):
+                indegree[d] += 1
+
+        roots = self.boxes if name is None else [name]
+        ready = [n for n in roots if indegree[n] == 0]
+        ordered = []
+        while ready:
+            n = ready.pop(0)
+            ordered.append(n)
+            box = self.find_box(n)
+            if box is None: continue
+            for (s,o,d,i) in sorted(self.outlinks(box)):
+                indegree[d] -= 1
+                if indegree[d] == 0:
+                    ready.append(d)
+        if len(ordered) != len(affected):
+            raise Exception('Cycle detected in the graph' if name is None
+                            else 'Cycle detected downstream of box %r' % name)
+        return ordered
 
     def find_box(self, name):
-        for box in self.boxes:
-            if box.name == name:
-                return box
+        return self.boxes.get(name)
 
     def inlinks(self, box):
-        return [ (s, o, d, i) for (s, o, d, i) in self.links
-                 if d==box.name ]
+        return list(self._inlinks.get(box.name, []))
 
     def outlinks(self, box):
-        return [ (s, o, d, i) for (s, o, d, i) in self.links
-                 if s==box.name ]
+        return list(self._outlinks.get(box.name, []))
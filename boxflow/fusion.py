@@ -0,0 +1,107 @@
+# Module fusing elementwise subgraphs into single kernels
+#
+# Boxes whose instances declare the names of their elementwise inputs
+# and an apply method (e.g. interface.imagen.BinaryOp and Invert) are
+# fusable: their output only depends on their input arrays, combined
+# through apply(*arrays, out=None). A chain of fusable boxes (such as
+# Sub -> Mul -> Invert -> Viewport) is then evaluated as one kernel that
+# evaluates the non-fusable inputs of the chain (e.g. the patterns) and
+# applies the operations directly, skipping the parameter resolution,
+# coordinate grids and intermediate arrays of each PatternGenerator call.
+#
+# Kernels are compiled by the DataFlow whenever its structure changes.
+from __future__ import absolute_import
+
+import numpy as np
+
+from .cache import evaluate
+
+
+def elementwise(instance):
+    "Whether the instance declares elementwise inputs"
+    return getattr(instance, 'elementwise', None) is not None
+
+
+def fusable(instance):
+    """
+    Whether the instance combines its inputs elementwise without any
+    further mask, scaling, offset, output functions or batched
+    parameters (see boxflow.batching).
+    """
+    return (elementwise(instance)
+            and not getattr(instance, '_boxflow_batch', None)
+            and getattr(instance, 'scale', 1.0) == 1.0
+            and getattr(instance, 'offset', 0.0) == 0.0
+            and getattr(instance, 'mask_shape', None) is None
+            and not getattr(instance, 'output_fns', []))
+
+
+class Kernel(object):
+    """
+    Fused evaluation of a fusable instance and of the fusable boxes it
+    is fed from (each feeding only into this subgraph). Inputs given as
+    None are evaluated with boxflow.cache.evaluate at run time.
+    """
+
+    def __init__(self, instance, inputs):
+        self.instance = instance
+        self.inputs = inputs # Elementwise input name to Kernel or None
+
+    def __call__(self, **params):
+        "Called by boxflow.cache.evaluate in place of the instance"
+        if not fusable(self.instance):
+            return self.instance(**params)
+        return self.run()[0]
+
+    def run(self):
+        """
+        Return the result and whether it is a new array (that may be
+        written into) rather than a shared input.
+        """
+        arrays, owned = [], []
+        for name in self.instance.elementwise:
+            source, kernel = getattr(self.instance, name), self.inputs.get(name)
+            if (kernel is not None and kernel.instance is source
+                and fusable(source)):
+                arr, own = kernel.run()
+            else:
+                arr, own = evaluate(source), False
+            arrays.append(arr)
+            owned.append(own)
+
+        shape = np.broadcast(*arrays).shape
+        dtype = np.result_type(*arrays)
+        out = None
+        for arr, own in zip(arrays, owned):
+            if own and arr.shape == shape and arr.dtype == dtype:
+                out = arr # Reuse an intermediate array of this kernel
+                break
+        result = self.instance.apply(*arrays, out=out)
+        shared = [arr for arr, own in zip(arrays, owned) if not own]
+        return result, not any(result is arr for arr in shared)
+
+
+def compile(dataflow):
+    """
+    Attach a Kernel to every box of the DataFlow declaring elementwise
+    inputs (see Box.fuse), removing the kernels of all the other boxes.
+    Whether boxes are fusable given their parameters is checked when
+    the kernels are run.
+    """
+    kernels = {}
+
+    def kernel(name):
+        if name not in kernels:
+            box = dataflow.find_box(name)
+            inputs = {}
+            for (s,o,d,i) in dataflow.inlinks(box):
+                source = dataflow.find_box(s)
+                if (source is not None and elementwise(source.instance)
+                    and len(dataflow.outlinks(source)) == 1):
+                    inputs[i] = kernel(s)
+            kernels[name] = Kernel(box.instance, inputs)
+        return kernels[name]
+
+    for name, box in dataflow.boxes.items():
+        box.fuse(kernel(name) if elementwise(box.instance) else None)
+    return kernels
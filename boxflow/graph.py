@@ -0,0 +1,126 @@
+# Module defining the graph document format
+#
+# A graph document is a JSON object of the form:
+#
+# {'version': 1,
+#  'boxes': [{'type': 'imagen.Disk', 'name': 'Disk00001', 'params': {...}}],
+#  'links': [{'src': ..., 'output': ..., 'dest': ..., 'input': ...}]}
+#
+# Boxes and links hold the same data as the add_node and add_edge
+# messages sent by the client. Parameters fed by links or left at their
+# defaults are omitted.
+#
+# Documents may be stored as JSON or, more compactly, as msgpack.
+from __future__ import absolute_import
+
+import json
+import fractions
+
+from .dataflow import DataFlow
+from .cache import hashable
+try: # pip install msgpack
+    import msgpack
+except:
+    msgpack = None
+
+version = 1
+
+
+def _jsonable(value):
+    "Whether a parameter value can be stored in a graph document"
+    if isinstance(value, fractions.Fraction):
+        return False
+    try:
+        json.dumps(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def _default(parameter, value):
+    "Whether a parameter value equals the default of the parameter (by content)"
+    return (value is parameter.default or
+            hashable(value, content=True) == hashable(parameter.default, content=True))
+
+
+def export_graph(dataflow):
+    """
+    Return the graph document describing the given DataFlow. Parameters
+    that differ from their defaults must be stored in the document, else
+    an exception is raised, unless they are internal state rebuilt by
+    the box (parameters of negative precedence, such as the random
+    generators of imagen patterns).
+    """
+    boxes = []
+    for name, box in dataflow.boxes.items():
+        linked = set(i for (s,o,d,i) in dataflow.inlinks(box))
+        parameters = box.instance.params()
+        params = {}
+        for k, v in box.instance.get_param_values():
+            parameter = parameters[k]
+            if k == 'name' or k in linked or _default(parameter, v):
+                continue
+            elif _jsonable(v):
+                params[k] = v
+            elif parameter.precedence is None or parameter.precedence >= 0:
+                raise Exception('Parameter %r of box %r cannot be stored in '
+                                'a graph document (value %r)' % (k, name, v))
+        boxes.append({'type': box.inventory.qualified_name(box.boxtype),
+                      'name': name, 'params': params})
+    links = [{'src':s, 'output':o, 'dest':d, 'input':i}
+             for (s,o,d,i) in sorted(dataflow.links)]
+    return {'version': version, 'boxes': boxes, 'links': links}
+
+
+def import_graph(document, inventory, dataflow=None):
+    """
+    Add the boxes and links of the graph document to the given DataFlow
+    (or a new one) in one bulk operation so that every box is evaluated
+    once. Returns the DataFlow and the names of all its boxes in
+    topological order.
+    """
+    if document.get('version', 1) > version:
+        raise Exception('Unsupported graph document version %r'
+                        % document['version'])
+    boxes = []
+    for spec in document['boxes']:
+        boxtype = inventory.lookup_boxtype(spec['type'])
+        if boxtype is None:
+            raise Exception('Unknown box type %r' % spec['type'])
+        boxes.append(boxtype(inventory, name=spec['name'], **spec['params']))
+    links = [(link['src'], link['output'], link['dest'], link['input'])
+             for link in document['links']]
+    dataflow = DataFlow() if dataflow is None else dataflow
+    return dataflow, dataflow.add_graph(boxes, links)
+
+
+def dumps(document, format='json'):
+    "Serialize a graph document as 'json' (a string) or 'msgpack' (bytes)"
+    if format == 'msgpack':
+        if msgpack is None:
+            raise Exception('Please pip install msgpack')
+        return msgpack.packb(document, use_bin_type=True)
+    return json.dumps(document, indent=1, sort_keys=True)
+
+
+def loads(data):
+    "Deserialize a graph document from JSON or msgpack"
+    if isinstance(data, bytes) and not data.lstrip().startswith(b'{'):
+        if msgpack is None:
+            raise Exception('Please pip install msgpack')
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data.decode('utf8') if isinstance(data, bytes) else data)
+
+
+def save(dataflow, filename):
+    "Save the graph document of the DataFlow (as msgpack given a .msgpack file)"
+    format = 'msgpack' if filename.endswith('.msgpack') else 'json'
+    data = dumps(export_graph(dataflow), format)
+    with open(filename, 'wb' if format == 'msgpack' else 'w') as f:
+        f.write(data)
+
+
+def load(filename):
+    "Load a graph document saved as JSON or msgpack"
+    with open(filename, 'rb') as f:
+        return loads(f.read())
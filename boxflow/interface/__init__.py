@@ -1,32 +1,15 @@
-# Loads extension classes from supported libraries
+# Registers the extension classes from supported libraries
+#
+# The plugins are only imported when their definitions are first needed
+# so that unused libraries (e.g. imagen, holoviews) are never imported.
 
 from __future__ import absolute_import
 from .inventory import Inventory
 
-from .param import load_param            # Param is a core dependency
-from .numbergen import  load_numbergen   # Numbergen is included
-
-
-try:
-    import imagen
-    from .imagen import load_imagen
-except:
-    load_imagen = None
-
-
-try:
-    import holoviews
-    from .holoviews import load_holoviews
-except:
-    load_holoviews = None
-
-load_param()
-load_numbergen()
-
-if load_imagen:
-    load_imagen()
-
-if load_holoviews:
-    load_holoviews()
+Inventory.register('param', 'boxflow.interface.param:load_param')
+Inventory.register('numbergen', 'boxflow.interface.numbergen:load_numbergen')
+Inventory.register('imagen', 'boxflow.interface.imagen:load_imagen')
+Inventory.register('holoviews', 'boxflow.interface.holoviews:load_holoviews')
+Inventory.discover()
 
 __all__ = ['Inventory']
@@ -4,19 +4,19 @@
 from __future__ import absolute_import
 
 import os
-import base64
-from PIL import Image
-from io import BytesIO
 
 import imagen
 from imagen import PatternGenerator, Gaussian
-from imagen import image
 from imagen import random
 from imagen.random import RandomGenerator
 from imagen.transferfn import TransferFn
+from PIL import Image
 
 import numpy as np
 import copy
+import weakref
+import threading
+from collections import OrderedDict
 
 import param
 import fractions
@@ -28,8 +28,45 @@ param.Dynamic.time_dependent = True
 TimeAware.time_dependent = True # Why can't I set it on RandomGenerator?
 
 from .inventory import Inventory, BoxType
+from ..cache import evaluate, hashable
+from .. import cache
+from .. import blur
+from .. import memory
+from .. import batching
+from .. import profiling
+
+class SharedCoordinates(object):
+    """
+    Mixin for PatternGenerators taking their coordinate grids from the
+    process-wide boxflow.cache.grids, so that patterns rendered with the
+    same bounds, density, position and orientation share them instead
+    of regenerating them on every evaluation. The shared grids are
+    read-only.
+    """
 
-class Viewport(PatternGenerator):
+    def _setup_xy(self, bounds, xdensity, ydensity, x, y, orientation):
+        if cache.grids is None:
+            return super(SharedCoordinates, self)._setup_xy(bounds, xdensity, ydensity,
+                                                            x, y, orientation)
+        key = (bounds.lbrt(), xdensity, ydensity, x, y, orientation)
+        grids = cache.grids.get(key)
+        if grids is None:
+            super(SharedCoordinates, self)._setup_xy(bounds, xdensity, ydensity,
+                                                     x, y, orientation)
+            grids = np.array([self.pattern_x, self.pattern_y])
+            cache.grids.put(key, grids)
+        self.pattern_x, self.pattern_y = grids
+
+
+def shared_coordinates(patgen):
+    "Subclass of the given PatternGenerator using SharedCoordinates"
+    if issubclass(patgen, SharedCoordinates):
+        return patgen
+    return type(patgen.__name__, (SharedCoordinates, patgen),
+                {'__doc__': patgen.__doc__, '__module__': __name__})
+
+
+class Viewport(SharedCoordinates, PatternGenerator):
     """
     Trivial wrapper around a pattern generator used to define a viewport
     node.
@@ -47,13 +84,18 @@ class Viewport(PatternGenerator):
     output_fns = param.HookList(default=[], precedence=-1)
     mask_shape = param.ClassSelector(param.Parameterized, default=None, precedence=-1)
 
+    elementwise = ['input'] # Inputs combined by apply (see boxflow.fusion)
+
+    def apply(self, arr, out=None):
+        return arr
+
     def function(self,p):
-        return p.input()
+        return evaluate(p.input)
 
 
 
 
-class BinaryOp(PatternGenerator):
+class BinaryOp(SharedCoordinates, PatternGenerator):
 
     lhs = param.ClassSelector(class_=PatternGenerator,
                               default=imagen.Constant(), precedence=1)
@@ -70,52 +112,189 @@ class BinaryOp(PatternGenerator):
     output_fns = param.HookList(default=[], precedence=-1)
     mask_shape = param.ClassSelector(param.Parameterized, default=None, precedence=-1)
 
+    ufunc = None # NumPy ufunc combining the lhs and rhs arrays
 
-class Add(BinaryOp):
+    elementwise = ['lhs', 'rhs'] # Inputs combined by apply (see boxflow.fusion)
+
+    def apply(self, lhs, rhs, out=None):
+        return self.ufunc(lhs, rhs, out=out)
 
     def function(self,p):
-        return (p.lhs + p.rhs)()
+        lhs, rhs = evaluate(p.lhs), evaluate(p.rhs)
+        return self.apply(lhs, rhs, out=memory.output(self, lhs, rhs))
 
 
-class Sub(BinaryOp):
+class Add(BinaryOp):
 
-    def function(self,p):
-        return (p.lhs - p.rhs)()
+    ufunc = np.add
 
 
-class Mul(BinaryOp):
+class Sub(BinaryOp):
 
-    def function(self,p):
-        return (p.lhs * p.rhs)()
+    ufunc = np.subtract
 
 
+class Mul(BinaryOp):
+
+    ufunc = np.multiply
 
-def image_to_base64(arr):
-    im = Image.fromarray((arr * 255))
-    buff = BytesIO()
-    im.convert('RGBA').save(buff, format='png')
-    buff.seek(0)
-    b64 = base64.b64encode(buff.read())
-    return 'data:image/png;base64,' + b64.decode('utf8')
 
 
 def imagen_display(instance):
     """
     Similar to a display hook. Returns a dictionary of extra content if
-    applicable.
+    applicable. The image array is encoded for the websocket according
+    to the transport (see boxflow.transport). Stacks of images (see
+    boxflow.batching) are shown as a contact sheet.
     """
-    return {'b64':image_to_base64(instance())}
+    image = evaluate(instance)
+    if image.ndim > 2:
+        image = batching.montage(image)
+    return {'image':image}
+
+
+def imagen_preview(instance, width, height):
+    """
+    Density overrides rendering the pattern at roughly the given display
+    size in pixels, if that is smaller than its full resolution.
+    """
+    (l, b, r, t) = instance.bounds.lbrt()
+    xdensity = max(int(width / float(r - l)), 1)
+    ydensity = max(int(height / float(t - b)), 1)
+    if xdensity >= instance.xdensity and ydensity >= instance.ydensity:
+        return {}
+    return {'xdensity': min(xdensity, instance.xdensity),
+            'ydensity': min(ydensity, instance.ydensity)}
 
 
 fpath, _ = os.path.split(__file__)
 manhattan_path = os.path.abspath(os.path.join(fpath, '..',
                                               'assets', 'manhattan.png'))
 
-class FileImage(image.FileImage):
+class ImageSource(object):
+    """
+    Grayscale image decoded once and shared by all the FileImage boxes
+    reading the same file. NumPy .npy files (2D arrays or 3D arrays of
+    channels) are memory-mapped so that only the pixels sampled are
+    read; other files are decoded with PIL.
+
+    As with imagen's default PatternSampler, the image is normalized by
+    its maximum absolute value and sampled outside its bounds as the
+    average of its edges. The maximum is only computed when the image
+    is first sampled: for a memory-mapped file, this reads the whole
+    file once (in chunks of 64MB).
+    """
 
-    def __init__(self, *args, **kwargs):
-        super(FileImage, self).__init__(*args, **dict(kwargs,
-                                                      filename=manhattan_path))
+    def __init__(self, filename, key=None):
+        self.key = key
+        if filename.lower().endswith('.npy'):
+            self.data = np.load(filename, mmap_mode='r')
+        else:
+            self.data = np.asarray(Image.open(filename).convert('L'), dtype=np.float64)
+            self.data.flags.writeable = False
+        if self.data.ndim not in [2, 3]:
+            raise Exception('Image %r is not a 2D or 3D array' % filename)
+        self._stats = None # (norm, background) computed on first use
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """
+        The maximum absolute value of the image (1 if all zero) and the
+        normalized average of its edges.
+        """
+        with self._lock:
+            if self._stats is None:
+                step = max((64 * 1024**2) // max(self.data[0].nbytes, 1), 1)
+                norm = max(np.abs(self.gray(self.data[i:i+step])).max()
+                           for i in range(0, len(self.data), step))
+                norm = float(norm) or 1.0
+                edges = [self.gray(self.data[0]), self.gray(self.data[-1]),
+                         self.gray(self.data[1:-1,0]), self.gray(self.data[1:-1,-1])]
+                self._stats = (norm, float(np.concatenate(edges).mean()) / norm)
+        return self._stats
+
+    def gray(self, arr):
+        "Average the channels of the given pixels (if any)"
+        return arr if self.data.ndim == 2 else arr.mean(axis=-1)
+
+    def sample(self, x, y, xdensity, ydensity, width, height):
+        """
+        Sample the image at the given pattern coordinates, scaling its
+        shortest dimension to fill the unit bounds (as imagen's
+        'fit_shortest' size normalization) and then to width and height.
+        """
+        rows, cols = self.data.shape[:2]
+        (norm, background) = self.stats()
+        if width == 0 or height == 0 or rows == 0 or cols == 0:
+            return np.ones(x.shape) * background
+        sf = rows / float(ydensity) if rows < cols else cols / float(xdensity)
+        x = x * (xdensity * sf / float(width))
+        y = y * (ydensity * sf / float(height))
+        r = np.floor(rows / 2.0 - y).astype(int).clip(0, rows - 1)
+        c = np.floor(x + cols / 2.0).astype(int).clip(0, cols - 1)
+        inside = ((x >= -cols / 2.0) & (x < cols / 2.0)
+                  & (y > -rows / 2.0) & (y <= rows / 2.0))
+        return np.where(inside, self.gray(self.data[r, c]) / norm,
+                        background)
+
+
+_sources = weakref.WeakValueDictionary() # File key to ImageSource
+_sources_lock = threading.Lock()
+
+_resampled = cache.EvaluationCache(128 * 1024**2) # Resampled FileImages
+
+
+def image_source(filename):
+    """
+    Return the ImageSource of the given file, shared while any box uses
+    it or any of its resampled versions is cached (see FileImage).
+    Sources are reloaded when the file is modified.
+    """
+    path = os.path.abspath(filename)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime, stat.st_size)
+    with _sources_lock:
+        source = _sources.get(key)
+        if source is None:
+            source = ImageSource(path, key)
+            _sources[key] = source
+    return source
+
+
+class FileImage(SharedCoordinates, PatternGenerator):
+    """
+    Grayscale image read from a file (see ImageSource). The decoded
+    image is shared between all the boxes reading the same file and
+    its resampled versions are cached per resolution, position,
+    orientation and size. The image is kept in memory for as long as
+    any of its resampled versions is cached.
+    """
+
+    filename = param.String(default=manhattan_path, precedence=0.9, doc="""
+      Path to an image in any format supported by PIL (e.g. PNG or
+      TIFF) or to a NumPy .npy file holding a 2D array or a 3D array
+      of channels.""")
+
+    aspect_ratio = param.Number(default=1.0, bounds=(0.0,None),
+                                softbounds=(0.0,2.0), precedence=0.31, doc="""
+      Ratio of width to height; size*aspect_ratio gives the width.""")
+
+    size = param.Number(default=1.0, bounds=(0.0,None),
+                        softbounds=(0.0,2.0), precedence=0.30, doc="""
+      Height of the image.""")
+
+    def function(self,p):
+        source = image_source(p.filename)
+        # The cached results hold the source (in their key) while cached
+        key = (source, p.bounds.lbrt(), p.xdensity, p.ydensity,
+               p.x, p.y, p.orientation, p.size, p.aspect_ratio)
+        result = _resampled.get(key)
+        if result is None:
+            result = source.sample(self.pattern_x, self.pattern_y,
+                                         p.xdensity, p.ydensity,
+                                         p.size * p.aspect_ratio, p.size)
+            _resampled.put(key, result)
+        return result.copy() # Cached results are read-only
 
 
 
@@ -142,22 +321,49 @@ class Convolve(TransferFn):
                                            kernel_xdensity,
                                            kernel_ydensity)
         self.kernel = pattern_copy()
+        self._kernel_ffts = {} # Image shape to real FFT of the kernel
+
+    def kernel_fft(self, shape):
+        "Real FFT of the kernel zero-padded to the given shape (cached)"
+        if shape not in self._kernel_ffts:
+            self._kernel_ffts[shape] = np.fft.rfft2(self.kernel, s=shape)
+        return self._kernel_ffts[shape]
 
     def __call__(self, x):
         if not hasattr(self, 'kernel'):
             raise Exception("Convolve must be initialized before being called.")
-        fft1 = np.fft.fft2(x)
-        fft2 = np.fft.fft2(self.kernel, s=x.shape)
-        convolved_raw = np.fft.ifft2( fft1 * fft2).real
+        fft1 = np.fft.rfft2(x)
+        fft1 *= self.kernel_fft(x.shape)
+        convolved_raw = np.fft.irfft2(fft1, s=x.shape)
 
         k_rows, k_cols = self.kernel.shape  # ORIGINAL
-        rolled = np.roll(np.roll(convolved_raw, -(k_cols//2), axis=-1), -(k_rows//2), axis=-2)
-        convolved = rolled / float(self.kernel.sum())
-        x.fill(0.0)
-        x+=convolved
+        rolled = np.roll(convolved_raw, (-(k_rows//2), -(k_cols//2)), axis=(-2, -1))
+        np.divide(rolled, float(self.kernel.sum()), out=x)
+
 
+_convolutions = OrderedDict() # Kernel key to initialized Convolve
+_convolutions_lock = threading.Lock()
 
-class Blur(PatternGenerator):
+def convolution(kernel, density, max_entries=16):
+    """
+    Return an initialized Convolve for the given kernel pattern and
+    kernel density, reused for as long as the kernel parameters are
+    unchanged so the kernel is rendered and transformed only once.
+    """
+    state = [(k,v) for k,v in kernel.get_param_values() if k != 'name']
+    key = (type(kernel), hashable(state), density)
+    with _convolutions_lock:
+        conv = _convolutions.pop(key, None)
+        if conv is None:
+            conv = Convolve(kernel_pattern=kernel)
+            conv.initialize(density, density, kernel_pattern=kernel)
+        _convolutions[key] = conv
+        while len(_convolutions) > max_entries:
+            _convolutions.popitem(last=False)
+    return conv
+
+
+class Blur(SharedCoordinates, PatternGenerator):
     """
     Trivial wrapper around a pattern generator used to define a viewport
     node.
@@ -174,6 +380,16 @@ class Blur(PatternGenerator):
       The kernel pattern used in the convolution. The default kernel
       results in an isotropic Gaussian blur.""")
 
+    engine = param.ObjectSelector(default='auto', precedence=1,
+                                  objects=['auto', 'convolve', 'fft',
+                                           'separable', 'box', 'pyramid'],
+                                  doc="""
+      The blur engine (see boxflow.blur) used for isotropic Gaussian
+      kernels. The 'auto' engine is chosen according to the blur radius
+      and image size among those matching the 'convolve' engine (a
+      convolution with the rendered kernel), which other kernels always
+      use.""")
+
     x = param.Number(default=0.0,softbounds=(-1.0,1.0),precedence=-1)
     y = param.Number(default=0.0,softbounds=(-1.0,1.0),precedence=-1)
     orientation = param.Number(default=0.0,precedence=-1)
@@ -183,17 +399,54 @@ class Blur(PatternGenerator):
     output_fns = param.HookList(default=[], precedence=-1)
     mask_shape = param.ClassSelector(param.Parameterized, default=None, precedence=-1)
 
-    def function(self,p):
-        arr = p.input()
-        conv = Convolve(kernel_pattern=p.kernel)
-        conv.initialize(p.blur_amount, p.blur_amount, kernel_pattern=p.kernel)
-        conv(arr)
-        return arr
-
+    @classmethod
+    def gaussian_sigma(cls, kernel, blur_amount):
+        """
+        The standard deviation in pixels of an isotropic Gaussian kernel
+        rendered at blur_amount density or None for any other kernel
+        (including Gaussians truncated by the kernel bounds).
+        """
+        if not (type(kernel) is Gaussian and kernel.aspect_ratio == 1.0
+                and kernel.x == 0 and kernel.y == 0 and kernel.size <= 0.25
+                and kernel.mask_shape is None and not kernel.output_fns):
+            return None
+        return kernel.size / 2.0 * blur_amount
 
-
-
-class Invert(PatternGenerator):
+    def function(self,p):
+        # Blur over the same area when rendered at a lower (preview) density
+        density = p.blur_amount * p.xdensity / float(self.xdensity)
+        sigma = self.gaussian_sigma(p.kernel, density)
+        arr = evaluate(p.input)
+        engine = p.engine
+        if sigma is None:
+            engine = 'convolve'
+        elif engine == 'auto':
+            engine = blur.select_engine(sigma, arr.shape[-2:])
+
+        with profiling.stage('blur:' + engine, self.name):
+            if arr.ndim > 2: # Stack of images (see boxflow.batching)
+                return batching.map_images(
+                    lambda image: self.blur_image(image, engine, sigma, p.kernel, density),
+                    arr)
+            return self.blur_image(arr, engine, sigma, p.kernel, density)
+
+    def blur_image(self, arr, engine, sigma, kernel, density):
+        "Blur a single image with the given engine"
+        if engine != 'convolve':
+            return blur.engines[engine](arr, sigma)
+        out = memory.output(self, arr)
+        if out is None:
+            out = arr.copy()
+        else:
+            out[...] = arr
+        conv = convolution(kernel, density)
+        conv(out) # Convolved in place
+        return out
+
+
+
+
+class Invert(SharedCoordinates, PatternGenerator):
     """
     Trivial wrapper around a pattern generator used to define a viewport
     node.
@@ -209,11 +462,15 @@ class Invert(PatternGenerator):
     output_fns = param.HookList(default=[], precedence=-1)
     mask_shape = param.ClassSelector(param.Parameterized, default=None, precedence=-1)
 
+    elementwise = ['input'] # Inputs combined by apply (see boxflow.fusion)
+
+    def apply(self, arr, out=None):
+        # Inverted within each image of a stack (see boxflow.batching)
+        return np.subtract(arr.max(axis=(-2, -1), keepdims=True), arr, out=out)
+
     def function(self,p):
-        arr = p.input()
-        mina, maxa = arr.min(), arr.max()
-        zeros = np.zeros(arr.shape)
-        return (zeros - arr) + maxa
+        arr = evaluate(p.input)
+        return self.apply(arr, out=memory.output(self, arr))
 
 
 binary_ops = [ BoxType(Sub, untyped=['lhs','rhs']),
@@ -224,15 +481,17 @@ patterngenerators = [imagen.Disk, imagen.Gaussian, imagen.Line,
                      imagen.ConcentricRings, imagen.Asterisk, FileImage,
                      imagen.random.GaussianRandom, imagen.random.GaussianCloud,
                      imagen.random.UniformRandom, imagen.random.UniformRandomInt]
-vanilla_classes = [ BoxType(patgen,
+vanilla_classes = [ BoxType(shared_coordinates(patgen),
                             nodetype='ImageNode',
-                            display_fn=imagen_display)
+                            display_fn=imagen_display,
+                            preview_fn=imagen_preview)
                     for patgen in patterngenerators ]
 
 
 imageops = [BoxType(Blur, nodetype='ImageNode',
                     untyped=['input'],
-                    display_fn=imagen_display),
+                    display_fn=imagen_display,
+                    preview_fn=imagen_preview),
             BoxType(Invert,
                     untyped=['input'])]
 
@@ -243,6 +502,7 @@ def load_imagen():
     Inventory.add('imagen',  BoxType(Viewport,
                                      nodetype='Viewport',
                                      untyped=['input'],
-                                     display_fn=imagen_display))
+                                     display_fn=imagen_display,
+                                     preview_fn=imagen_preview))
 
 
@@ -2,9 +2,19 @@
 #
 #
 from __future__ import absolute_import
-from collections import defaultdict
+import json
+import inspect
+import hashlib
+import importlib
+from collections import defaultdict, OrderedDict
+
+import param
+import numpy as np
 
 from .paramDatGUI import ParamDatGUI
+from ..cache import hashable, content_state, overrides as _overrides
+from ..batching import Batch
+from .. import profiling
 
 class BoxType(object):
     """
@@ -13,16 +23,21 @@ class BoxType(object):
     """
 
     def __init__(self, typeobj, nodetype='LabelledNode',
-                 untyped=[], hidden=[], relabel={}, buttons={}, display_fn = None):
+                 untyped=[], hidden=[], relabel={}, buttons={}, display_fn = None,
+                 preview_fn=None):
         self.typeobj = typeobj
         self.nodetype = nodetype
         self.relabel = relabel
         self.buttons = buttons
         self.display_fn = display_fn if display_fn else lambda x: {}
+        # Maps (instance, width, height) to the overrides rendering a preview
+        self.preview_fn = preview_fn if preview_fn else lambda x, w, h: {}
 
         self.name = typeobj.name
         self.untyped = set(getattr(typeobj, 'untyped', [])) | set(untyped)
         self.hidden = set(getattr(typeobj, 'hidden', [])) | set(hidden)
+        # Names of the output ports, passed to the propagate method
+        self.outputs = list(getattr(typeobj, 'outputs', ['']))
 
 
     def mode(self, name):
@@ -49,6 +64,54 @@ class BoxType(object):
         return Box(self, inventory, *args, **kwargs)
 
 
+def _time_dependent(obj, seen=None):
+    """
+    Whether the given Parameterized object is time dependent or has a
+    time dependent parameter value (Parameterized objects checked in
+    turn and any other callable value generator of a Dynamic parameter).
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return False
+    seen.add(id(obj))
+    if getattr(obj, 'time_dependent', False):
+        return True
+    for name, parameter in obj.params().items():
+        value = obj.param.get_value_generator(name)
+        if isinstance(value, param.Parameterized):
+            if _time_dependent(value, seen):
+                return True
+        elif isinstance(parameter, param.Dynamic) and callable(value):
+            return True
+    return False
+
+
+def _batchable(instance):
+    """
+    Whether batches fed to the instance can be evaluated (see
+    cache.evaluate): it must be called with parameter overrides, not
+    propagate its values downstream as numbergen and param boxes do.
+    """
+    if hasattr(instance, 'propagate') or not callable(instance):
+        return False
+    argspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec
+    return argspec(instance.__call__)[2] is not None
+
+
+def _validated_batch(parameter, batch):
+    """
+    The given batch with the values of the numeric parameter, raising
+    ValueError if any value is not valid for it (e.g. integral within
+    the bounds of an Integer parameter).
+    """
+    if (isinstance(parameter, param.Integer)
+        and np.array_equal(batch.values, np.round(batch.values))):
+        batch = Batch(batch.axes, batch.values, dtype=int)
+    for value in batch.values.flat:
+        parameter._validate(value.item())
+    return batch
+
+
 class Box(object):
     """
     A Box is an instance of a BoxType. A Box is to a BoxType what a
@@ -65,18 +128,97 @@ class Box(object):
         self.instance = boxtype.typeobj(*args, **kwargs)
         self.name = self.instance.name
 
+        self.key = None  # Evaluation key assigned by the DataFlow
+        self.version = 0 # Incremented whenever the key changes
+        self.timed = False # Whether the key depends on the time (see DataFlow)
+        self.batches = {} # Parameter name to Batch fed to the box
+
 
-    def display(self):
-        return self.boxtype.display_fn(self.instance)
+    def display(self, overrides={}):
+        "Display the instance, evaluating with the given parameter overrides"
+        with profiling.stage('display', self.name), _overrides(**overrides):
+            return self.boxtype.display_fn(self.instance)
+
+    def preview_overrides(self, width, height):
+        """
+        Parameter overrides rendering a preview of the box at the given
+        display size in pixels (empty if a preview would not be cheaper).
+        """
+        return self.boxtype.preview_fn(self.instance, width, height)
 
-    def propagate(self):
-        return (self.instance.propagate()
-                if hasattr(self.instance, 'propagate') else self.instance)
+    def propagate(self, output=''):
+        "The value of the named output port (see BoxType.outputs)"
+        if not hasattr(self.instance, 'propagate'):
+            return self.instance
+        elif output and output in self.boxtype.outputs:
+            return self.instance.propagate(output)
+        return self.instance.propagate()
 
     def set_param(self, *args, **kwargs):
+        """
+        Set the parameters of the instance except for Batch values of
+        numeric parameters, which are validated value by value, held in
+        batches and evaluated by boxflow.cache.evaluate (see
+        boxflow.batching). Raises ValueError for batches the box cannot
+        evaluate.
+        """
         # Can get button definition from boxtype.
+        self.memoize(None, None) # Stale until the DataFlow refreshes it
+        for name in list(kwargs):
+            parameter = self.params().get(name)
+            if not isinstance(kwargs[name], Batch):
+                self.batches.pop(name, None)
+            elif not _batchable(self.instance):
+                raise ValueError('Box %r cannot evaluate batches' % self.name)
+            elif isinstance(parameter, param.Number):
+                self.batches[name] = _validated_batch(parameter, kwargs.pop(name))
+            else:
+                raise ValueError('Parameter %r of %r cannot be batched'
+                                 % (name, self.name))
+        self.instance._boxflow_batch = dict(self.batches) or None
         self.instance.set_param(*args, **kwargs)
 
+    def state(self, excluded=[], content=False):
+        """
+        Hashable representation of the parameter values of the instance.
+        If content is set, the instance and any Parameterized values are
+        represented by content (see cache.content_state) so that equal
+        boxes of different DataFlows have equal states.
+        """
+        if content:
+            return (content_state(self.instance, excluded),
+                    hashable(sorted(self.batches.items()), content=True))
+        excluded = set(excluded) | {'name'}
+        if getattr(self.instance, 'time_dependent', False):
+            # Reseeded from the name, seed and time whenever called
+            excluded.add('random_generator')
+        return hashable([(k,v) for k,v in self.instance.get_param_values()
+                         if k not in excluded] + sorted(self.batches.items()))
+
+    def time_dependent(self):
+        """
+        Whether the instance varies with param.Dynamic.time_fn, either as
+        it is time dependent itself (e.g. random streams reseeded by time)
+        or through the value of one of its parameters.
+        """
+        return _time_dependent(self.instance)
+
+    def memoize(self, cache, key, time=None):
+        """
+        Make boxflow.cache.evaluate use the given cache and key when
+        calling the instance (or disable memoization if cache is None).
+        If the key was computed for a time, the memoized result is only
+        used at that time.
+        """
+        self.instance._boxflow_memo = None if cache is None else (cache, key, time)
+
+    def fuse(self, kernel):
+        """
+        Make boxflow.cache.evaluate call the given fused kernel instead
+        of the instance (or the instance itself if kernel is None).
+        """
+        self.instance._boxflow_fused = kernel
+
     def script_repr(self,imports=[],prefix="    "):
         return self.instance.script_repr()
 
@@ -105,46 +247,146 @@ class Inventory(object):
     """
     The Inventory holds all available BoxType definitions and offers the
     means to serialize these definitions to JSON.
+
+    Serialized definitions are cached per (excluded, gui) key and shared
+    by all connections until the definitions change.
+
+    BoxTypes are supplied by plugins: load functions registered per group
+    by module path that are only imported when the definitions or a
+    BoxType of that group are first needed. Only the enabled groups are
+    loaded (all registered groups if enabled is None).
     """
 
     definitions = {}
 
+    plugins = OrderedDict() # Group name to 'module.path:load_function'
+
+    enabled = None
+
+    _loaded = set()
+
+    _serialized = {} # (excluded, gui) key to (etag, JSON string)
+
+    _boxtypes = {}   # Qualified 'group.name' to BoxType
+    _groups = defaultdict(list) # BoxType name to groups in registration order
+
     guis = {'datgui': ParamDatGUI }
 
     @classmethod
     def _boxlist(cls, blist):
         return [el if isinstance(el, BoxType) else BoxType(el) for el in blist]
 
+    @classmethod
+    def register(cls, group, path):
+        """
+        Register a plugin group given the path to its load function in
+        the form 'module.path:load_function'. The load function is
+        expected to call Inventory.add for the group.
+        """
+        cls.plugins[group] = path
+
+    @classmethod
+    def discover(cls, entry_point_group='boxflow.plugins'):
+        """
+        Register the plugins advertised by installed packages through
+        entry points named by group (e.g. 'mygroup = mypkg.boxes:load').
+        """
+        try:
+            from importlib.metadata import entry_points
+            eps = entry_points()
+            eps = (eps.select(group=entry_point_group)
+                   if hasattr(eps, 'select') else eps.get(entry_point_group, []))
+            for ep in eps:
+                cls.register(ep.name, ep.value)
+        except ImportError:
+            import pkg_resources
+            for ep in pkg_resources.iter_entry_points(entry_point_group):
+                cls.register(ep.name, ep.module_name + ':' + ep.attrs[0])
+
+    @classmethod
+    def enable(cls, groups):
+        "Set the plugin groups to load (None to load all registered groups)."
+        cls.enabled = None if groups is None else list(groups)
+
+    @classmethod
+    def load(cls, group=None):
+        """
+        Import and run the load function of the given plugin group (or
+        of all enabled groups) unless already loaded. Plugins with
+        missing dependencies are skipped with a warning.
+        """
+        enabled = list(cls.plugins) if cls.enabled is None else cls.enabled
+        groups = enabled if group is None else [group]
+        for group in groups:
+            if (group in cls._loaded or group not in enabled
+                or group not in cls.plugins):
+                continue
+            cls._loaded.add(group)
+            module, load_fn = cls.plugins[group].split(':')
+            try:
+                getattr(importlib.import_module(module), load_fn)()
+            except ImportError as e:
+                print('Warning: Could not load %r plugin (%s)' % (group, e))
+
     @classmethod
     def add(cls, group, definition):
 
         definition = definition if isinstance(definition, list) else [definition]
         boxtypes = cls._boxlist(definition)
 
+        qualified = [group + '.' + boxtype.name for boxtype in boxtypes]
+        duplicates = [q for q in qualified if q in cls._boxtypes]
+        if duplicates or len(set(qualified)) != len(qualified):
+            raise Exception('BoxTypes already registered: %s'
+                            % ', '.join(duplicates or qualified))
+
         if group not in cls.definitions:
             cls.definitions[group] = defaultdict(list)
 
-        for boxtype in boxtypes:
+        for boxtype, name in zip(boxtypes, qualified):
             cls.definitions[group][boxtype.nodetype].append(boxtype)
+            cls._boxtypes[name] = boxtype
+            cls._groups[boxtype.name].append(group)
+        cls._serialized.clear()
 
 
     @classmethod
     def lookup_boxtype(cls, name):
         """
-        Find the appropriate BoxType associated with the given name.
+        Find the appropriate BoxType associated with the given name,
+        which may be qualified by group (e.g. 'imagen.Disk'). If an
+        unqualified name is registered in several groups, the first
+        registration is returned.
         """
-        for spec in cls.definitions.values():
-            for boxlist in spec.values():
-                for boxtype in boxlist:
-                    if boxtype.name == name:
-                        return boxtype
+        cls.load(name.split('.')[0] if '.' in name else None)
+        if name in cls._boxtypes:
+            return cls._boxtypes[name]
+        groups = cls._groups.get(name)
+        if not groups:
+            return None
+        if len(groups) > 1:
+            print('Warning (lookup_boxtype): %r is ambiguous, using %r'
+                  % (name, groups[0] + '.' + name))
+        return cls._boxtypes[groups[0] + '.' + name]
+
+    @classmethod
+    def qualified_name(cls, boxtype):
+        "The 'group.name' under which the given BoxType was registered"
+        for group in cls._groups.get(boxtype.name, []):
+            if cls._boxtypes[group + '.' + boxtype.name] is boxtype:
+                return group + '.' + boxtype.name
+        return boxtype.name
 
     @classmethod
     def json(cls, excluded, gui):
         """
         Generate a JSON-serializable parameter definitions for the given
-        parameterized objects.
+        parameterized objects. Definitions are keyed by BoxType name,
+        qualified by group (see qualified_name) if the name is registered
+        in several groups. The client sends this key as the type of new
+        boxes (see lookup_boxtype).
         """
+        cls.load()
         json_obj = {}
         for group, defs in cls.definitions.items():
             for nodetype, boxlist in defs.items():
@@ -152,10 +394,27 @@ class Inventory(object):
                     inputs = cls.guis[gui].json_inputs(boxtype, excluded)
                     outputs = cls.guis[gui].json_outputs(boxtype)
                     buttons = cls.guis[gui].json_buttons(boxtype)
-                    json_obj[boxtype.name] = {'inputs'  : inputs,
+                    key = (group + '.' + boxtype.name
+                           if len(cls._groups[boxtype.name]) > 1 else boxtype.name)
+                    json_obj[key] = {'inputs'  : inputs,
                                               'outputs' : outputs,
                                               'buttons' : buttons,
                                               'nodetype': nodetype,
                                               'group'   : group }
         return json_obj
 
+
+    @classmethod
+    def serialized(cls, excluded, gui):
+        """
+        Return an (etag, JSON string) tuple for the definitions, computing
+        it only the first time for a given (excluded, gui) key. The etag is
+        a digest of the JSON and identifies an unchanged set of definitions.
+        """
+        cls.load()
+        key = (tuple(sorted(excluded)), gui)
+        if key not in cls._serialized:
+            serialized = json.dumps(cls.json(excluded, gui), sort_keys=True)
+            etag = hashlib.sha1(serialized.encode('utf8')).hexdigest()
+            cls._serialized[key] = (etag, serialized)
+        return cls._serialized[key]
@@ -5,12 +5,80 @@ from __future__ import absolute_import
 import param
 import numbergen
 import operator
+import random
+
+import numpy as np
 
 from .inventory import Inventory, BoxType
 
 param.Dynamic.time_dependent = True
 numbergen.UniformRandom.time_dependent = True
 
+def samples(value, times, memo=None):
+    """
+    Array of the values taken by the given parameter value at each of
+    the given times. Boxes offering a samples method compute them in
+    one vectorized call while other callables are evaluated at each
+    time in turn and constants are repeated.
+
+    The samples of each generator are memoized in memo (a dictionary
+    for the given times, by default one per call) so that generators
+    feeding several others over the same times are only sampled once.
+    """
+    memo = {} if memo is None else memo
+    if id(value) in memo:
+        return memo[id(value)][1]
+    if hasattr(value, 'samples'):
+        result = value.samples(times, memo)
+    elif callable(value):
+        values = []
+        for time in times:
+            with param.Dynamic.time_fn as time_fn:
+                time_fn(time)
+                values.append(value())
+        result = np.array(values)
+    else:
+        return np.full(len(times), value)
+    memo[id(value)] = (value, result) # Holds value so that its id is not reused
+    return result
+
+
+class Sampled(object):
+    """
+    Mixin for number generators with a samples method: prefetch stores
+    their samples over the given times so that calling the generator at
+    one of these times (with the same random seed) looks the value up,
+    e.g. for the frames of a playback (see boxflow.playback).
+    """
+
+    _prefetched = {}
+
+    def prefetch(self, times, memo=None):
+        """
+        Store the samples over the given times if they are determined by
+        the time and seed, replacing those stored before (no times clears
+        them). The caller ensures that the parameters do not change
+        until they are cleared.
+        """
+        if not times or not self.time_hashed():
+            self._prefetched = {}
+            return
+        time_type = param.Dynamic.time_fn.time_type
+        values = samples(self, times, memo)
+        self._prefetched = {(time_type(time), param.random_seed): value
+                            for time, value in zip(times, values.tolist())}
+
+    def time_hashed(self):
+        "Whether the values are determined by the time and random seed alone"
+        return False
+
+    def __call__(self):
+        key = (param.Dynamic.time_fn(), param.random_seed)
+        if key in self._prefetched:
+            return self._prefetched[key]
+        return super(Sampled, self).__call__()
+
+
 class Percentage(param.Parameterized):
 
     percent = param.Number(default=50, bounds=(0,100))
@@ -19,7 +87,7 @@ class Percentage(param.Parameterized):
         return self.percent
 
 
-class BinaryOp(numbergen.NumberGenerator):
+class BinaryOp(Sampled, numbergen.NumberGenerator):
 
     lhs = param.Number(default=0)
 
@@ -29,12 +97,49 @@ class BinaryOp(numbergen.NumberGenerator):
                                              'div','truediv','floordiv'])
 
     def __call__(self):
+        key = (param.Dynamic.time_fn(), param.random_seed)
+        if key in self._prefetched:
+            return self._prefetched[key]
         op = getattr(operator, self.operator)
         return op(self.lhs() if callable(self.lhs) else self.lhs,
                   self.rhs() if callable(self.rhs) else self.rhs)
 
-class URandom(numbergen.UniformRandom): # TODO: Namespace properly
-    pass
+    def samples(self, times, memo=None):
+        "Apply the operator to the samples of both operands at once"
+        op = getattr(operator, self.operator)
+        return op(samples(self.param.get_value_generator('lhs'), times, memo),
+                  samples(self.param.get_value_generator('rhs'), times, memo))
+
+    def time_hashed(self):
+        operands = [self.param.get_value_generator(name) for name in ['lhs', 'rhs']]
+        return all(isinstance(operand, Sampled) and operand.time_hashed()
+                   or not callable(operand) for operand in operands)
+
+class URandom(Sampled, numbergen.UniformRandom): # TODO: Namespace properly
+
+    def samples(self, times, memo=None):
+        """
+        The values returned by calling the instance at each of the given
+        times, seeded as in numbergen (by hashing the time and
+        param.random_seed) but without setting the global time.
+        """
+        if not self.time_dependent:
+            return np.array([self() for _ in times])
+        time_type = self.time_fn.time_type # Times as hashed by __call__
+        generator = random.Random()
+        draws = np.empty(len(times))
+        for i, time in enumerate(times):
+            generator.seed(self._hashfn(time_type(time), param.random_seed))
+            draws[i] = generator.random()
+        lbound, ubound = (samples(self.param.get_value_generator(name), times, memo)
+                          for name in ['lbound', 'ubound'])
+        return lbound + (ubound - lbound) * draws # As in random.uniform
+
+    def time_hashed(self):
+        bounds = [self.param.get_value_generator(name) for name in ['lbound', 'ubound']]
+        return self.time_dependent and all(
+            isinstance(bound, Sampled) and bound.time_hashed()
+            or not callable(bound) for bound in bounds)
 
 def load_numbergen():
     Inventory.add('numbergen', [BoxType(Percentage, hidden=['percent']),
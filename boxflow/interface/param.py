@@ -4,8 +4,10 @@
 from __future__ import absolute_import
 import param
 import fractions
+import numpy as np
 
 from .inventory import Inventory, BoxType
+from ..batching import Batch
 from collections import OrderedDict
 
 param.Dynamic.time_fn(val=0.0, time_type=fractions.Fraction)
@@ -47,6 +49,14 @@ class Time(param.Parameterized):
 
     step = param.Number(default=1)
 
+    frames = param.Integer(default=50, bounds=(1, None),
+                           doc="Number of time steps to play back")
+
+    fps = param.Number(default=10, bounds=(0.1, 60),
+                       doc="Target frame rate of the playback")
+
+    playback = True # Play and stop buttons handled by boxflow.command.Command
+
     def propagate(self):
         return float(param.Dynamic.time_fn(fractions.Fraction(self.time)))
 
@@ -56,6 +66,66 @@ class Time(param.Parameterized):
     def decrement(self):
         self.time -= self.step
 
+    def play(self):
+        "Playback is rendered and streamed by the server"
+
+    def stop(self):
+        "Stop the playback"
+
+
+class Sweep(param.Parameterized):
+    """
+    Range of count evenly spaced values from start to stop (inclusive)
+    propagated as a batch: the boxes it feeds are evaluated over every
+    value at once and images are shown as a contact sheet.
+    """
+
+    start = param.Number(default=0.0)
+
+    stop = param.Number(default=1.0)
+
+    count = param.Integer(default=5, bounds=(1, 64))
+
+    @property
+    def batch_axes(self):
+        return [self.name]
+
+    def propagate(self):
+        return Batch(self.batch_axes, np.linspace(self.start, self.stop, self.count))
+
+
+class Grid(param.Parameterized):
+    """
+    Cartesian grid of x and y values, with x running over the columns
+    and y over the rows (from y_stop down to y_start so that a contact
+    sheet is laid out as the plane). The x and y outputs are batches
+    over the same two axes, e.g. to feed the position of a pattern.
+    """
+
+    x_start = param.Number(default=-0.5)
+
+    x_stop = param.Number(default=0.5)
+
+    x_count = param.Integer(default=3, bounds=(1, 16))
+
+    y_start = param.Number(default=-0.5)
+
+    y_stop = param.Number(default=0.5)
+
+    y_count = param.Integer(default=3, bounds=(1, 16))
+
+    outputs = ['x', 'y']
+
+    @property
+    def batch_axes(self):
+        return [self.name + '.y', self.name + '.x']
+
+    def propagate(self, output='x'):
+        y, x = np.meshgrid(np.linspace(self.y_stop, self.y_start, self.y_count),
+                           np.linspace(self.x_start, self.x_stop, self.x_count),
+                           indexing='ij')
+        return Batch(self.batch_axes, x if output == 'x' else y)
+
 
 class ToolBox(param.Parameterized):
     """
@@ -92,5 +162,8 @@ def load_param():
                                                                String, Boolean, Magnitude]]
     Inventory.add('param', boxtypes +
                   [BoxType(Time, buttons=OrderedDict([('increment','+'),
-                                                      ('decrement','-')])),
+                                                      ('decrement','-'),
+                                                      ('play','Play'),
+                                                      ('stop','Stop')])),
+                   BoxType(Sweep), BoxType(Grid),
                    BoxType(ToolBox, buttons = dict(randomize='Randomize'))])
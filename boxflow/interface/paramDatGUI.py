@@ -2,7 +2,6 @@
 
 from __future__ import absolute_import
 import param
-import imagen
 
 class ParamDatGUI(object):
 
@@ -103,7 +102,8 @@ class ParamDatGUI(object):
 
     @classmethod
     def json_outputs(cls, boxtype):
-        return  [ {'name':'', 'lims':[], 'mode':'untyped-port'}]
+        return  [ {'name':name, 'lims':[], 'mode':'untyped-port'}
+                  for name in boxtype.outputs]
 
 
     @classmethod
@@ -88,6 +88,34 @@ class BaseBox {
 
         for ( let out_edge of graph.node_edges(node, 'output') ) {
             Connector.update_connector(view, out_edge) }
+
+        if (node.stats_text) {
+            node.stats_text.set({left: left, top: top - 16});
+        }
+    }
+
+    static update_stats(node, canvas, stats) {
+        // Overlay the evaluation cost reported by the server (--profile)
+        let ms = (stage) => stats[stage] ?
+            (stats[stage].last * 1000).toFixed(1) + ' ms' : '-';
+        let encoded = _.find(Object.keys(stats), (k) => k.startsWith('encode:'));
+        let kb = encoded ?
+            (stats[encoded].bytes / stats[encoded].count / 1024).toFixed(1) + ' kB' : '';
+        let text = `display ${ms('display')}  eval ${ms('evaluate')}  ${kb}`;
+        if (!node.stats_text) {
+            node.stats_text = new fabric.Text(text, {
+                fontSize : 10,
+                fill : 'DimGray',
+                selectable : false,
+                evented : false });
+        }
+        node.stats_text.set({text: text,
+                             left: node.geom.left,
+                             top: node.geom.top - 16});
+        if (!_.contains(canvas.getObjects(), node.stats_text)) {
+            canvas.add(node.stats_text);
+        }
+        canvas.renderAll();
     }
 }
 
@@ -192,6 +220,13 @@ class ImageBox extends LabelledBox {
         if (node.image) {
             node.image.setSrc(node.image_opts.imdata,
                               (img) => {
+                                  // Previews may have a lower resolution
+                                  let element = node.image.getElement();
+                                  node.image.set({
+                                      width: element.width,
+                                      height: element.height,
+                                      scaleX: node.image_opts.width / element.width,
+                                      scaleY: node.image_opts.height / element.height});
                                   view.lookup(node).dirty = true;
                                   canvas.renderAll() });
         }
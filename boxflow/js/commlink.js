@@ -2,13 +2,24 @@
 class CommLink {
 
     constructor(view, gui, graph, server, port=8891) {
-        this.socket = new WebSocket("ws://"+server+":"+port+"/ws");
+        // Send the etag of stored definitions so the server can skip them
+        let etag = window.localStorage ?
+            localStorage.getItem('boxflow-definitions-etag') : null;
+        let query = etag ? '?definitions=' + etag : '';
+        this.socket = new WebSocket("ws://"+server+":"+port+"/ws" + query);
+        this.socket.binaryType = 'arraybuffer'; // For binary image frames
 
         this.view = view;
         this.gui = gui;
         this.graph = graph;
 
         this.setup(this.socket)
+        // Keep the session (including node positions) across page reloads
+        this.store_session = _.debounce(() => this.save_session(), 500);
+        window.addEventListener('beforeunload', () => this.save_session());
+        // Report the on-screen image sizes once zooming settles
+        view.canvas.on('zoom:changed',
+                       _.debounce(() => this.display_sizes(), 250));
     }
 
     setup(socket) {
@@ -30,19 +41,63 @@ class CommLink {
         console.log('Socket error');
     }
 
+    decode_frame(buffer) {
+        // Binary frames: uint32 header length, JSON header, payload bytes
+        let length = new DataView(buffer).getUint32(0, true);
+        let header = new TextDecoder('utf-8').decode(
+            new Uint8Array(buffer, 4, length));
+        let json = JSON.parse(header);
+        let data = json['data'];
+        let payload = new Uint8Array(buffer, 4 + length);
+
+        if (data['codec'] == 'raw') { // 8-bit grayscale pixels
+            let canvas = document.createElement('canvas');
+            canvas.width = data['width'];
+            canvas.height = data['height'];
+            let context = canvas.getContext('2d');
+            let imdata = context.createImageData(data['width'], data['height']);
+            for (let i = 0; i < payload.length; i++) {
+                imdata.data[4*i] = payload[i];
+                imdata.data[4*i+1] = payload[i];
+                imdata.data[4*i+2] = payload[i];
+                imdata.data[4*i+3] = 255;
+            }
+            context.putImageData(imdata, 0, 0);
+            data['b64'] = canvas.toDataURL();
+        }
+        else if (data['codec'] == 'png') {
+            let blob = new Blob([payload], {type: 'image/png'});
+            data['b64'] = URL.createObjectURL(blob);
+            data['object_url'] = true;
+        }
+        return json
+    }
+
     socket_onmessage(e) { // Dispatch according to value of 'command'
-        let json = JSON.parse(e.data);
+        let json = (e.data instanceof ArrayBuffer) ?
+            this.decode_frame(e.data) : JSON.parse(e.data);
         if (json.command == 'definitions') {
-            this.graph.defs.definitions = json['data'];
-            this.gui.init();
-            _.screenshot(this.view, this.graph);
+            if (window.localStorage) {
+                localStorage.setItem('boxflow-definitions-etag', json['etag']);
+                localStorage.setItem('boxflow-definitions',
+                                     JSON.stringify(json['data']));
+            }
+            this.load_definitions(json['data']);
+        }
+        else if (json.command == 'definitions_unchanged') {
+            this.load_definitions(
+                JSON.parse(localStorage.getItem('boxflow-definitions')));
         }
         else if (json.command == 'image_update') {
             let node = this.graph.find_node(json['data']['name']);
             if (!node) {console.log('Warning: node not found'); return }
             let boxtype = this.graph.defs.boxtype(node.type);
             if (node.image_opts) {
+                if (node.image_opts.object_url) { // Release previous PNG blob
+                    URL.revokeObjectURL(node.image_opts.imdata);
+                }
                 node.image_opts.imdata = json['data']['b64'];
+                node.image_opts.object_url = json['data']['object_url'];
                 boxtype.update_image(node, this.view, true);
             }
         }
@@ -61,25 +116,85 @@ class CommLink {
                 console.log('Could not find node to update params')
             }
         }
+        else if (json.command == 'box_stats') {
+            let node = this.graph.find_node(json['data']['name']);
+            if (node) {
+                this.graph.defs.boxtype(node.type).update_stats(
+                    node, this.view.canvas, json['data']['stats']);
+            }
+        }
         else if (json.command == 'invalid_edge') {
             console.log('Invalid edge: ' + json['data']);
             this.view.remove(this.graph, json['data'], false); // Avoid looping back
         }
     }
 
+    load_definitions(definitions) {
+        this.graph.defs.definitions = definitions;
+        this.gui.init();
+        let session = window.localStorage ?
+            localStorage.getItem('boxflow-session') : null;
+        if (session) {
+            try { // Restored with a single load_graph message
+                this.graph.restore(this.view, JSON.parse(session));
+                return
+            }
+            catch (e) {
+                console.log('Could not restore session: ' + e);
+                localStorage.removeItem('boxflow-session');
+            }
+        }
+        _.screenshot(this.view, this.graph);
+    }
+
+    save_session() {
+        if (window.localStorage) {
+            localStorage.setItem('boxflow-session',
+                                 JSON.stringify(this.graph.document()));
+        }
+    }
+
     send_message(command, data) {
         if (this.socket.readyState === this.socket.OPEN ) {
             this.socket.send(JSON.stringify({'command': command,
                                              'data':data}));
+            this.store_session();
         }
         else {
             console.log('Socket not ready');
         }
     }
 
+    display_size(node) {
+        // Size in device pixels at which the node image is displayed
+        let scale = this.view.canvas.getZoom() * (window.devicePixelRatio || 1);
+        return [Math.ceil(node.image_opts.width * scale),
+                Math.ceil(node.image_opts.height * scale)];
+    }
+
+    display_sizes() { // Let the server render previews at the displayed size
+        for (let node of this.graph.nodes) {
+            if (node.image_opts) {
+                let [width, height] = this.display_size(node);
+                this.send_message('display_size',
+                                  {'name':node.name, 'width':width, 'height':height});
+            }
+        }
+    }
+
     add_node(node) {
         this.send_message('add_node',
-                          {'type':node.type, 'name':node.name, 'params':node.params});
+                          {'type':node.type, 'name':node.name, 'params':node.params,
+                           'display_size': node.image_opts ?
+                           this.display_size(node) : null});
+        this.watch_node(node);
+    }
+
+    load_graph(document) { // Send a whole graph (see boxflow/graph.py)
+        this.send_message('load_graph', document);
+    }
+
+    watch_node(node) {
         // Using watch.js to trigger update_params when the params change
         watch(node.params, () => {
             this.update_params(node);
@@ -91,6 +206,10 @@ class CommLink {
 
     }
 
+    save_graph() { // Save the graph on the server for batch evaluation
+        this.send_message('save_graph', {});
+    }
+
     node_repr(node) {
       this.send_message('node_repr',
                           {'type':node.type, 'name':node.name, 'params':node.params});
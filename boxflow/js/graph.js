@@ -44,6 +44,43 @@ class Graph {
         this.commlink && this.commlink.add_node(node);
     }
 
+    save() {
+      this.commlink && this.commlink.save_graph();
+    }
+
+    document() { // Graph document (see boxflow/graph.py) with node positions
+        let boxes = this.nodes.map((node) => {
+            return {type: node.type, name: node.name, params: node.params,
+                    pos: [node.geom.left, node.geom.top],
+                    display_size: (node.image_opts && this.commlink) ?
+                    this.commlink.display_size(node) : null} });
+        let links = this.edges.map((edge) => {
+            return {src: edge.src.name, output: edge.output,
+                    dest: edge.dest.name, input: edge.input} });
+        return {version: 1, boxes: boxes, links: links}
+    }
+
+    restore(view, document) { // Rebuild a graph document in a single message
+        let commlink = this.commlink;
+        this.commlink = undefined;
+        for (let box of document.boxes) {
+            view.add_node(this, box.type, box.name, {pos: box.pos}, false);
+            _.extend(this.find_node(box.name).params, box.params);
+        }
+        for (let link of document.links) {
+            let dest = this.find_node(link.dest);
+            this.add_edge(this.find_node(link.src), link.output, dest, link.input);
+            dest.lock_param(link.input);
+        }
+        this.commlink = commlink;
+        view.canvas.clear();
+        view.render(this);
+        if (commlink) {
+            for (let node of this.nodes) { commlink.watch_node(node) }
+            commlink.load_graph(this.document());
+        }
+    }
+
     node_repr(node) {
       this.commlink && this.commlink.node_repr(node);
     }
@@ -62,6 +99,7 @@ class Graph {
     }
 
     new_name(type) {   // Suggest a new name for an instance of the given type
+        let base = type.split('.').pop().toLowerCase(); // Without any group
         let existing = [];
         let num = 0;
         for (let node of this.nodes) {
@@ -69,10 +107,10 @@ class Graph {
                 existing.push(node.name);
             }
         }
-        while ( _.contains(existing, type.toLowerCase() + ':' + num) ) {
+        while ( _.contains(existing, base + ':' + num) ) {
             num += 1;
         }
-        return type.toLowerCase() + ':' +num
+        return base + ':' +num
     }
 
     node_edges(node, type) { // Return either the 'input' or 'output' edges of a node
@@ -194,6 +194,7 @@ class ZoomTool {
         // TODO: Set zoom point to mouse position
         let point = new fabric.Point(this.canvas.width/2, this.canvas.height/2);
         this.canvas.zoomToPoint(point, this.canvas.getZoom() * amount);
+        this.canvas.fire('zoom:changed');
     }
 
     zoom_handler(e) {
@@ -248,6 +249,9 @@ class KeyPressTool {
             else if ( e.key == '-') {
                 this.zoom_tool.zoomOut();
             }
+            else if ( e.key == 's') {
+                this.graph.save();
+            }
         } , false);
     }
 
@@ -89,7 +89,7 @@ class View {
         }
     }
 
-    add_node(graph, type, name, options={}) { // TODO: Work by group
+    add_node(graph, type, name, options={}, render=true) { // TODO: Work by group
         let opts = {
             name: name,
             type : type,
@@ -103,8 +103,10 @@ class View {
 
         let nodetype = graph.defs.nodetype(type);
         graph.add_node( new nodetype(_.extend(opts, options)));
-        this.canvas.clear();
-        this.render(graph);
+        if (render) {
+            this.canvas.clear();
+            this.render(graph);
+        }
     }
 
     render(graph) {
@@ -129,6 +131,9 @@ class View {
             for ( let edge of edges ) {
                 canvas.remove(this.lookup(edge));
             }
+            if (object.node.stats_text) {
+                this.canvas.remove(object.node.stats_text);
+            }
         }
         this.canvas.remove(object);
         graph.remove(name, comm)
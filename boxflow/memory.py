@@ -0,0 +1,132 @@
+# Module offering reusable output buffers and memory instrumentation
+from __future__ import absolute_import
+
+import weakref
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class BufferPool(object):
+    """
+    Pool of output arrays owned by the objects (e.g. PatternGenerators)
+    that write into them. An owner is handed back the same buffer every
+    time it asks for one of the same shape and dtype so that repeated
+    evaluations do not allocate. Buffers are dropped with their owner.
+
+    As a buffer is overwritten on every evaluation of its owner, any
+    cached result held in it must be discarded when the owner changes
+    (see EvaluationCache.keep_stale). Buffers may be held (e.g. while a
+    worker encodes a display) in which case their owner is handed a new
+    buffer until they are unheld.
+    """
+
+    def __init__(self):
+        self.allocations = 0 # Number of buffers allocated
+        self.nbytes = 0      # Bytes allocated over the lifetime of the pool
+        self._buffers = weakref.WeakKeyDictionary() # Owner to {key: array}
+        self._held = {} # Id of held buffer to [buffer, number of holds]
+        self._lock = threading.Lock()
+
+    def acquire(self, owner, shape, dtype=np.float64):
+        "Return the writeable buffer of the given shape and dtype for owner"
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            buffers = self._buffers.setdefault(owner, {})
+            if key not in buffers or id(buffers[key]) in self._held:
+                buffers[key] = np.empty(shape, dtype=dtype)
+                self.allocations += 1
+                self.nbytes += buffers[key].nbytes
+        buff = buffers[key]
+        buff.flags.writeable = True # May have been made read-only by a cache
+        return buff
+
+    def release(self, owner):
+        "Drop the buffers held for owner"
+        with self._lock:
+            self._buffers.pop(owner, None)
+
+    def hold(self, arrays):
+        """
+        Hold the buffers underlying the given arrays (other values are
+        ignored) so that they are not handed out again, returning the
+        list of buffers to pass to unhold.
+        """
+        held = []
+        for arr in arrays:
+            while isinstance(arr, np.ndarray) and isinstance(arr.base, np.ndarray):
+                arr = arr.base
+            if isinstance(arr, np.ndarray):
+                held.append(arr)
+        with self._lock:
+            for buff in held:
+                self._held.setdefault(id(buff), [buff, 0])[1] += 1
+        return held
+
+    def unhold(self, held):
+        "Release buffers returned by hold"
+        with self._lock:
+            for buff in held:
+                entry = self._held[id(buff)]
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._held[id(buff)]
+
+
+pool = None # BufferPool enabling in-place evaluation (None to disable)
+
+
+def output(owner, *arrays):
+    """
+    Return the pooled output buffer for an elementwise operation by owner
+    over the given arrays (suitable as the out argument of a NumPy ufunc),
+    or None to allocate a new array when no pool is enabled.
+    """
+    if pool is None:
+        return None
+    shape = np.broadcast(*arrays).shape
+    return pool.acquire(owner, shape, np.result_type(*arrays))
+
+
+def hold(arrays):
+    """
+    Hold the pooled buffers of the given arrays (see BufferPool.hold)
+    while they are used outside the evaluation (e.g. digested and encoded
+    by a worker), returning the value to pass to unhold.
+    """
+    return (pool, []) if pool is None else (pool, pool.hold(arrays))
+
+
+def unhold(held):
+    "Release the buffers returned by hold"
+    (held_pool, buffers) = held
+    if held_pool is not None:
+        held_pool.unhold(buffers)
+
+
+@contextmanager
+def peak_memory(enabled=True):
+    """
+    Context manager measuring the peak number of bytes allocated by
+    Python and NumPy (via tracemalloc) within the block. The yielded
+    dictionary holds 'peak' and 'current' once the block exits.
+    """
+    usage = {}
+    if not enabled:
+        yield usage
+        return
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    else:
+        tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    try:
+        yield usage
+    finally:
+        current, peak = tracemalloc.get_traced_memory()
+        if started:
+            tracemalloc.stop()
+        usage.update(peak=peak - baseline, current=current - baseline)
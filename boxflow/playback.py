@@ -0,0 +1,83 @@
+# Module rendering successive time steps of a dataflow graph
+from __future__ import absolute_import
+from collections import deque
+
+from .transport import digest
+from . import memory
+
+
+class Playback(object):
+    """
+    Playback of a time box (e.g. interface.param.Time) over a number of
+    time steps. Frames are rendered ahead of time in batches and
+    buffered as encoded image_update messages so that they may be
+    streamed to the client at the target frame rate.
+
+    As param.Dynamic.time_fn is global, frames are rendered one after
+    the other. Results are memoized by time (see DataFlow._refresh) so
+    replaying the same time steps only encodes the frames again.
+    """
+
+    def __init__(self, command, name, frames, fps=10, batch=8):
+        self.command = command
+        self.name = name
+        self.fps = fps
+        self.batch = batch
+        box = command.dataflow.find_box(name)
+        self.times = [box['time'] + (i+1) * box['step'] for i in range(frames)]
+        self.rendered = 0       # Number of frames rendered
+        self.buffered = deque() # Frames rendered but not yet sent
+        self._digests = dict(command._digests) # Box name to last rendered
+
+    @property
+    def done(self):
+        return self.rendered == len(self.times) and not self.buffered
+
+    def render(self):
+        """
+        Render the next batch of frames into the buffer. Number
+        generators that are not downstream of the time box (and offer
+        a prefetch method, see interface.numbergen) are sampled over
+        all the times of the batch at once beforehand.
+        """
+        dataflow = self.command.dataflow
+        times = self.times[self.rendered:self.rendered + self.batch]
+        downstream = dataflow.downstream(self.name)
+        sampled = [box.instance for name, box in dataflow.boxes.items()
+                   if hasattr(box.instance, 'prefetch') and name not in downstream]
+        memo = {}
+        for instance in sampled:
+            instance.prefetch(times, memo)
+        try:
+            self._render(times)
+        finally:
+            for instance in sampled:
+                instance.prefetch([])
+
+    def _render(self, times):
+        dataflow = self.command.dataflow
+        for time in times:
+            frame = []
+            for name in dataflow.update_params(self.name, {'time':time}):
+                box = dataflow.find_box(name)
+                if box is None: continue
+                overrides = self.command.preview_overrides(box)
+                display = dict(box.display(overrides), name=name)
+                held = memory.hold(display.values()) # As in Command._display
+                try:
+                    display_digest = digest(display)
+                    if display_digest == self._digests.get(name):
+                        continue
+                    self._digests[name] = display_digest
+                    frame.append((name, display_digest)
+                                 + self.command.encode('image_update', display))
+                finally:
+                    memory.unhold(held)
+            self.buffered.append((time, frame))
+            self.rendered += 1
+
+    def clear(self):
+        "Drop the buffered frames so they are rendered again"
+        self.rendered -= len(self.buffered)
+        self.buffered.clear()
+        self._digests = dict(self.command._digests)
@@ -0,0 +1,76 @@
+# Module offering optional instrumentation of the hot paths
+#
+# Stages are recorded by name (e.g. 'dispatch:add_node', 'display',
+# 'encode:png', 'send') overall and per box, with their call count,
+# total and last duration and the number of bytes produced.
+from __future__ import absolute_import
+import threading
+from timeit import default_timer
+from contextlib import contextmanager
+from collections import defaultdict
+
+
+class Profiler(object):
+    """
+    Thread-safe accumulator of stage timings and byte counts.
+    """
+
+    def __init__(self):
+        self._stages = {}                 # Stage name to totals
+        self._boxes = defaultdict(dict)   # Box name to stage name to totals
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _add(cls, totals, stage, seconds, nbytes):
+        entry = totals.setdefault(stage, {'count':0, 'seconds':0.0,
+                                          'last':0.0, 'max':0.0, 'bytes':0})
+        entry['count'] += 1
+        entry['seconds'] += seconds
+        entry['last'] = seconds
+        entry['max'] = max(entry['max'], seconds)
+        entry['bytes'] += nbytes
+
+    def record(self, stage, seconds, nbytes=0, box=None):
+        with self._lock:
+            self._add(self._stages, stage, seconds, nbytes)
+            if box is not None:
+                self._add(self._boxes[box], stage, seconds, nbytes)
+
+    def box_stats(self, box):
+        "Totals per stage of the named box"
+        with self._lock:
+            return {k:dict(v) for k,v in self._boxes.get(box, {}).items()}
+
+    def stats(self):
+        "JSON-serializable snapshot of the totals overall and per box"
+        with self._lock:
+            return {'stages': {k:dict(v) for k,v in self._stages.items()},
+                    'boxes': {b:{k:dict(v) for k,v in stages.items()}
+                              for b, stages in self._boxes.items()}}
+
+    def reset(self):
+        with self._lock:
+            self._stages.clear()
+            self._boxes.clear()
+
+
+profiler = None # Profiler recording the stages (None to disable)
+
+
+@contextmanager
+def stage(name, box=None):
+    """
+    Context manager recording the duration of the block as the named
+    stage (of the named box) if profiling is enabled. The number of
+    bytes produced may be given as 'bytes' in the yielded dictionary.
+    """
+    if profiler is None:
+        yield {}
+        return
+    info = {}
+    start = default_timer()
+    try:
+        yield info
+    finally:
+        profiler.record(name, default_timer() - start,
+                        info.get('bytes', 0), box)
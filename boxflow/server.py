@@ -5,26 +5,67 @@ import param
 import time
 import json
 import sys
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 import tornado.httpserver
 import tornado.websocket
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 
 from .interface import Inventory
 from .command import Command
+from .cache import EvaluationCache
+from . import profiling
+from .transport import transports
+from . import memory
 
 
 
+class StatsHandler(tornado.web.RequestHandler):
+    "Serve the profiling statistics of the process as JSON"
+
+    def get(self):
+        if profiling.profiler is None:
+            raise tornado.web.HTTPError(404, 'Profiling is disabled')
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(profiling.profiler.stats()))
+
+
 class WSHandler(tornado.websocket.WebSocketHandler):
 
+    def initialize(self, executor=None, latency=0.05, transport='json',
+                   compress_level=1, track_memory=False, preview=True,
+                   idle=0.5, cache=None, fuse=False):
+        # Worker pool shared by all connections (None to display on the IOLoop)
+        self.executor = executor
+        self.latency = latency
+        self.transport = transport
+        self.compress_level = compress_level
+        self.track_memory = track_memory
+        self.preview = preview
+        self.idle = idle
+        self.cache = cache # Shared by all connections (None for one per connection)
+        self.fuse = fuse
+
     def open(self):
         print('New websocket connection')
 
         # seed/time_dependent probably have an issue with None...
         excluded = ['enforce_minimal_thickness', 'size', 'time_dependent', 'seed']
-        self.command = Command(self, Inventory, excluded=excluded)
-        self.command.push_definitions()
+        self.command = Command(self, Inventory, excluded=excluded,
+                               executor=self.executor,
+                               loop=tornado.ioloop.IOLoop.current(),
+                               latency=self.latency,
+                               transport=self.transport,
+                               compress_level=self.compress_level,
+                               track_memory=self.track_memory,
+                               preview=self.preview, idle=self.idle,
+                               cache=self.cache, fuse=self.fuse)
+        # Reconnecting clients send the etag of the definitions they hold
+        self.command.push_definitions(self.get_argument('definitions', None))
 
     def on_message(self, message):
          self.command.dispatch(json.loads(message))
@@ -76,17 +117,64 @@ def index_html(js_dir):
     return html.format(scripts='\n'.join(stags))
 
 
-def main(js_dir):
+def main(js_dir, workers=0, latency=0.05, transport='json', compress_level=1,
+         groups=None, buffer_pool=False, track_memory=False, preview=True,
+         idle=0.5, processes=1, share=False, profile=False, fuse=False):
+    """
+    Launch the websocket server on port 8891 and serve the HTML and JS
+    on port 8000. If workers is non-zero, boxes are evaluated and
+    encoded in a pool of that many threads instead of on the IOLoop.
+    Parameter updates arriving within latency seconds are coalesced.
+    Images are sent with the given transport (see boxflow.transport).
+    Only the given plugin groups are enabled (all if groups is None).
+    With buffer_pool, operator boxes write into reused output buffers and
+    track_memory reports the peak memory allocated by each update.
+    With preview, image boxes are first rendered at their size on screen
+    and at full resolution once the user has been idle for idle seconds
+    (immediately for viewports). With fuse, chains of elementwise
+    operator boxes are evaluated as fused kernels.
+
+    Each connection evaluates its graph with its own time and random
+    seed. With share, connections of the same process share one cache
+    so that identical subgraphs are evaluated once. Connections are
+    spread over the given number of forked processes (0 for one per
+    core) listening on the same ports.
+
+    With profile, the time spent in each stage overall and per box is
+    served as JSON on port 8891 under /stats and shown on the nodes.
+    """
+    Inventory.enable(groups)
+    if buffer_pool:
+        memory.pool = memory.BufferPool()
+    if share and buffer_pool:
+        print('Warning: Results held in pooled buffers cannot be shared')
+        share = False
+
     curdir = os.path.split(__file__)[0]
     with open(os.path.join(curdir,'index.html'),'w') as f:
         f.write(index_html(js_dir))
 
     host = os.environ['NODE_IP'] if 'NODE_IP' in os.environ else 'localhost'
 
-    application = tornado.web.Application([
-        (r'/ws', WSHandler)])
+    ws_sockets = tornado.netutil.bind_sockets(8891)
+    http_sockets = tornado.netutil.bind_sockets(8000)
+    if processes != 1:
+        tornado.process.fork_processes(processes)
 
-    tornado.httpserver.HTTPServer(application).listen(8891)
+    executor = ThreadPoolExecutor(workers) if workers else None
+    cache = EvaluationCache() if share else None
+    if profile:
+        profiling.profiler = profiling.Profiler()
+    application = tornado.web.Application([
+        (r'/ws', WSHandler, {'executor': executor, 'latency': latency,
+                             'transport': transport,
+                             'compress_level': compress_level,
+                             'track_memory': track_memory,
+                             'preview': preview, 'idle': idle,
+                             'cache': cache, 'fuse': fuse}),
+        (r'/stats', StatsHandler)])
+
+    tornado.httpserver.HTTPServer(application).add_sockets(ws_sockets)
     main_loop = tornado.ioloop.IOLoop.instance()
 
     # Serve HTML and JS
@@ -100,21 +188,60 @@ def main(js_dir):
     static_handler=(r'/static/(.*)', tornado.web.StaticFileHandler, {'path': static_path})
     assets_handler=(r'/assets/(.*)', tornado.web.StaticFileHandler, {'path': assets_path})
 
-    tornado.web.Application([html_handler,
-                             js_handler,
-                             static_handler,
-                             assets_handler]).listen(8000)
+    static_application = tornado.web.Application([html_handler,
+                                                  js_handler,
+                                                  static_handler,
+                                                  assets_handler])
+    tornado.httpserver.HTTPServer(static_application).add_sockets(http_sockets)
     print("Serving at:\n\n{host}:8000/index.html?server={host}\n".format(host=host))
     main_loop.start()
 
 
 def console_script():
-    if len(sys.argv) == 1:
-        js_dir = 'js'
-    elif sys.argv[1] == '-es5':
-        js_dir = 'es5'
-    else:
-        print("Only allowed argument is '-es5'")
-        sys.exit()
-
-    main(js_dir)
+    parser = argparse.ArgumentParser(description='Launch the boxflow server.')
+    parser.add_argument('-es5', action='store_true',
+                        help='Serve ES5 Javascript from the es5 directory.')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Number of worker threads used to evaluate boxes '
+                        '(default 0 evaluates on the IOLoop).')
+    parser.add_argument('--latency', type=float, default=50,
+                        help='Target latency in milliseconds within which '
+                        'parameter updates are coalesced (default 50).')
+    parser.add_argument('--transport', choices=transports, default='json',
+                        help='Image transport: base64 PNG data URIs in JSON '
+                        '(default) or binary frames of raw pixels or PNG.')
+    parser.add_argument('--compress-level', type=int, default=1,
+                        choices=range(10), metavar='[0-9]',
+                        help='PNG compression level for the png transport.')
+    parser.add_argument('--groups', default=None,
+                        help='Comma separated plugin groups to enable '
+                        '(default all of: %s).' % ', '.join(Inventory.plugins))
+    parser.add_argument('--buffer-pool', action='store_true',
+                        help='Evaluate operator boxes into reused buffers.')
+    parser.add_argument('--track-memory', action='store_true',
+                        help='Report the peak memory allocated by each update.')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of server processes sharing the ports '
+                        '(default 1, 0 for one per core).')
+    parser.add_argument('--share', action='store_true',
+                        help='Share results between connections viewing '
+                        'identical subgraphs.')
+    parser.add_argument('--profile', action='store_true',
+                        help='Record stage timings, served under /stats.')
+    parser.add_argument('--fuse', action='store_true',
+                        help='Evaluate chains of elementwise operator boxes '
+                        'as fused kernels.')
+    parser.add_argument('--no-preview', action='store_true',
+                        help='Always render images at full resolution.')
+    parser.add_argument('--idle', type=float, default=500,
+                        help='Milliseconds without updates after which '
+                        'previews are rendered at full resolution (default 500).')
+    args = parser.parse_args()
+    main('es5' if args.es5 else 'js', workers=args.workers,
+         latency=args.latency / 1000.0, transport=args.transport,
+         compress_level=args.compress_level,
+         groups=args.groups.split(',') if args.groups else None,
+         buffer_pool=args.buffer_pool, track_memory=args.track_memory,
+         preview=not args.no_preview, idle=args.idle / 1000.0,
+         processes=args.processes, share=args.share, profile=args.profile,
+         fuse=args.fuse)
@@ -0,0 +1,134 @@
+# Module isolating the global time and seed of concurrent sessions
+from __future__ import absolute_import
+import threading
+import itertools
+import fractions
+from collections import deque
+from contextlib import contextmanager
+
+import param
+
+
+class Session(object):
+    """
+    The time (param.Dynamic.time_fn) and random seed (param.random_seed)
+    of one client session. These are process-global in param, numbergen
+    and imagen, so a session swaps them in while it is active. Unless a
+    seed is given, every session gets its own seed (offset from
+    param.random_seed by the number of sessions created before it).
+
+    Any number of threads may evaluate boxes for the active session
+    (e.g. in a worker pool). Other sessions take turns in the order they
+    asked to be activated: once a session is waiting, the active session
+    admits no new work (besides nested activations) so that it becomes
+    idle and hands over. Worker threads wait for their turn (activate)
+    whereas the IOLoop never waits: its callbacks are queued and run on
+    the loop when it is the turn of the session (run).
+    """
+
+    _condition = threading.Condition()
+    _active = None    # The active session
+    _count = 0        # Number of activations within the active session
+    _queue = deque()  # Sessions waiting for their turn, in order
+    _local = threading.local() # Activation depth of each thread
+    _serial = itertools.count()
+
+    def __init__(self, time=0, seed=None):
+        self.time = fractions.Fraction(time)
+        self.seed = (param.random_seed + next(Session._serial)
+                     if seed is None else seed)
+        self._deferred = deque() # (loop, callback) run on the turn of the session
+
+    @classmethod
+    def _depth(cls):
+        return getattr(cls._local, 'depth', 0)
+
+    def _admit(self):
+        """
+        Enter the session (holding the condition) if possible: when it is
+        active and no other session is waiting (or the thread is already
+        within it) or when no session is active and it is its turn.
+        Otherwise queue the session and return False.
+        """
+        cls = Session
+        if cls._active is self and (cls._depth() or not cls._queue):
+            pass
+        elif cls._active is None and (not cls._queue or cls._queue[0] is self):
+            if cls._queue:
+                cls._queue.popleft()
+            cls._active = self
+            self._saved = (param.Dynamic.time_fn(), param.random_seed)
+            param.Dynamic.time_fn(self.time)
+            param.random_seed = self.seed
+        else:
+            if self not in cls._queue:
+                cls._queue.append(self)
+            return False
+        cls._count += 1
+        cls._local.depth = cls._depth() + 1
+        return True
+
+    def _release(self):
+        "Leave the session, handing over to the next waiting session once idle"
+        cls = Session
+        with cls._condition:
+            cls._count -= 1
+            cls._local.depth = cls._depth() - 1
+            if cls._count:
+                return
+            self.time = param.Dynamic.time_fn() # May have been set
+            (time, param.random_seed) = self._saved
+            param.Dynamic.time_fn(time)
+            cls._active = None
+            if self._deferred and self not in cls._queue:
+                cls._queue.append(self)
+            if cls._queue and cls._queue[0]._deferred:
+                (loop, _) = cls._queue[0]._deferred[0]
+                loop.add_callback(cls._queue[0]._resume)
+            cls._condition.notify_all()
+
+    @contextmanager
+    def activate(self):
+        """
+        Context manager running the block with the time and seed of the
+        session, waiting for its turn. Not to be used on the IOLoop.
+        """
+        with Session._condition:
+            while not self._admit():
+                Session._condition.wait()
+        try:
+            yield self
+        finally:
+            self._release()
+
+    def run(self, loop, callback):
+        """
+        Call callback within the session right away if possible, else
+        queue it to be called on the loop when it is the turn of the
+        session. Never waits so it is safe to use on the IOLoop. Queued
+        callbacks are called in order, before any later callback.
+        """
+        with Session._condition:
+            nested = Session._active is self and Session._depth()
+            if (self._deferred and not nested) or not self._admit():
+                self._deferred.append((loop, callback))
+                return
+        try:
+            callback()
+        finally:
+            self._release()
+
+    def _resume(self):
+        "Call the queued callbacks on the loop once it is the turn of the session"
+        with Session._condition:
+            if not self._deferred or not self._admit():
+                return
+        try:
+            while True:
+                with Session._condition:
+                    if not self._deferred:
+                        break
+                    (_, callback) = self._deferred.popleft()
+                callback()
+        finally:
+            self._release()
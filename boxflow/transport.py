@@ -0,0 +1,97 @@
+# Module encoding box displays into websocket messages
+#
+# Displays are dictionaries of JSON-serializable content. An 'image'
+# entry holding a 2D array with values in [0,1] is encoded according to
+# the chosen transport:
+#
+# 'json' : PNG encoded as a base64 data URI under 'b64' in a JSON message.
+# 'raw'  : Binary frame holding the 8-bit grayscale pixels.
+# 'png'  : Binary frame holding the PNG bytes.
+#
+# Binary frames consist of a four byte little-endian header length, a
+# UTF-8 JSON header of the form {'command':..., 'data':...} and the
+# payload bytes.
+from __future__ import absolute_import
+
+import json
+import base64
+import struct
+import hashlib
+from io import BytesIO
+
+import numpy as np
+try: # pip install pillow
+    from PIL import Image
+except:
+    Image = None
+
+transports = ['json', 'raw', 'png']
+
+
+def image_to_uint8(arr):
+    "Convert an array with values in [0,1] to 8-bit grayscale"
+    return (np.clip(arr, 0, 1) * 255).astype(np.uint8)
+
+
+def image_to_png(arr, compress_level=6):
+    "Encode an array with values in [0,1] as PNG bytes"
+    buff = BytesIO()
+    Image.fromarray(image_to_uint8(arr)).save(buff, format='png',
+                                               compress_level=compress_level)
+    return buff.getvalue()
+
+
+def image_to_base64(arr):
+    im = Image.fromarray((arr * 255))
+    buff = BytesIO()
+    im.convert('RGBA').save(buff, format='png')
+    buff.seek(0)
+    b64 = base64.b64encode(buff.read())
+    return 'data:image/png;base64,' + b64.decode('utf8')
+
+
+def digest(data):
+    """
+    Digest of a display dictionary used to detect displays identical to
+    the last one sent for a box.
+    """
+    data = dict(data)
+    arr = data.pop('image', None)
+    sha = hashlib.sha1(json.dumps(data, sort_keys=True).encode('utf8'))
+    if arr is not None:
+        arr = np.ascontiguousarray(arr)
+        sha.update(str((arr.shape, arr.dtype.str)).encode('utf8'))
+        sha.update(arr.data)
+    return sha.hexdigest()
+
+
+def binary_frame(command, data, payload):
+    "Pack a JSON header and payload bytes into a binary frame"
+    header = json.dumps({'command':command, 'data':data}).encode('utf8')
+    return struct.pack('<I', len(header)) + header + payload
+
+
+def encode_message(command, data, transport='json', compress_level=1):
+    """
+    Encode a message, returning a (message, binary) tuple suitable for
+    WebSocketHandler.write_message. Messages without an image are always
+    sent as JSON.
+    """
+    if 'image' not in data:
+        return json.dumps({'command':command, 'data':data}), False
+
+    data = dict(data)
+    arr = data.pop('image')
+    if transport == 'json':
+        data['b64'] = image_to_base64(arr)
+        return json.dumps({'command':command, 'data':data}), False
+
+    (rows, cols) = arr.shape[:2]
+    data.update(width=cols, height=rows, codec=transport)
+    if transport == 'raw':
+        payload = image_to_uint8(arr).tobytes()
+    elif transport == 'png':
+        payload = image_to_png(arr, compress_level)
+    else:
+        raise Exception('Unknown transport %r' % transport)
+    return binary_frame(command, data, payload), True
@@ -8,7 +8,7 @@ except ImportError:
 
 
 install_requires = ['tornado', 'param']
-extras_require={'all': ['imagen', 'pillow', 'pyperclip']}
+extras_require={'all': ['imagen', 'pillow', 'pyperclip', 'msgpack']}
 
 setup_args = dict(
     name='boxflow',
@@ -32,7 +32,8 @@ setup_args = dict(
                   'boxflow.static':['*.js']},
     entry_points={
         'console_scripts': [
-            'boxflow = boxflow.server:console_script'
+            'boxflow = boxflow.server:console_script',
+            'boxflow-batch = boxflow.batch:console_script'
         ]},
     classifiers = [
         "License :: OSI Approved :: BSD License",
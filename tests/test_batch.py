@@ -0,0 +1,36 @@
+from __future__ import absolute_import
+
+import param
+import pytest
+
+from boxflow.batch import evaluate_point
+from boxflow.cache import EvaluationCache
+from boxflow.dataflow import DataFlow
+from boxflow.interface import Inventory
+
+
+@pytest.fixture(autouse=True)
+def reset_time():
+    time = param.Dynamic.time_fn()
+    yield
+    param.Dynamic.time_fn(time)
+
+
+def make_box(group, type_name, name, **params):
+    Inventory.load(group)
+    return Inventory.lookup_boxtype(group + '.' + type_name)(Inventory, name=name, **params)
+
+
+def test_time_sweep_takes_precedence_over_time_box():
+    dataflow = DataFlow(cache=EvaluationCache())
+    dataflow.add_box(make_box('param', 'Time', 't', time=5))
+    dataflow.add_box(make_box('param', 'Number', 'n'))
+    dataflow.add_box(make_box('numbergen', 'URandom', 'u'))
+    dataflow.add_link('t', '', 'n', 'number')
+    values = []
+    for time in [0.5, 1, 2]:
+        results = evaluate_point(dataflow, {'time': time}, ['n', 'u'])
+        assert results['n'] == time
+        assert param.Dynamic.time_fn() == time
+        values.append(float(results['u']))
+    assert len(set(values)) == len(values)
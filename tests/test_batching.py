@@ -0,0 +1,108 @@
+from __future__ import absolute_import
+
+import numpy as np
+import param
+import pytest
+
+from boxflow.cache import EvaluationCache, evaluate
+from boxflow.dataflow import DataFlow
+from boxflow.interface import Inventory
+from boxflow.interface.inventory import BoxType
+
+
+class Source(param.Parameterized):
+    level = param.Number(default=1.0)
+
+    def __call__(self, **params):
+        return np.full((4, 4), float(params.get('level', self.level)))
+
+
+class Count(param.Parameterized):
+    count = param.Integer(default=1, bounds=(0, 10))
+
+    def __call__(self, **params):
+        return np.full((4, 4), params.get('count', self.count))
+
+
+class Scale(param.Parameterized):
+    "Scales an input image, one value of the factor at a time (as Blur)"
+    input = param.Parameter(default=None)
+    factor = param.Number(default=1.0)
+
+    def __call__(self, **params):
+        return evaluate(self.input) * float(params.get('factor', self.factor))
+
+
+def sweep_graph(*links):
+    Inventory.load('param')
+    dataflow = DataFlow(cache=EvaluationCache())
+    sweep = Inventory.lookup_boxtype('param.Sweep')
+    dataflow.add_box(sweep(Inventory, name='s', start=1, stop=5, count=5))
+    dataflow.add_box(sweep(Inventory, name='r', start=1, stop=3, count=3))
+    dataflow.add_box(BoxType(Source)(Inventory, name='source'))
+    dataflow.add_box(BoxType(Scale)(Inventory, name='scale'))
+    dataflow.add_link('source', '', 'scale', 'input')
+    for (src, dest, name) in links:
+        dataflow.add_link(src, '', dest, name)
+    return dataflow
+
+
+def test_batches_on_one_axis_are_zipped():
+    dataflow = sweep_graph(('s', 'source', 'level'), ('s', 'scale', 'factor'))
+    result = evaluate(dataflow.find_box('scale').instance)
+    assert result.shape[-2:] == (4, 4)
+    levels = np.linspace(1, 5, 5)
+    assert np.allclose(result.reshape(5, 16), (levels ** 2)[:, np.newaxis])
+
+
+def test_batches_on_two_axes_are_multiplied():
+    dataflow = sweep_graph(('s', 'source', 'level'), ('r', 'scale', 'factor'))
+    result = evaluate(dataflow.find_box('scale').instance)
+    expected = np.outer(np.linspace(1, 5, 5), np.linspace(1, 3, 3))
+    axes = dataflow.axes
+    if axes.index('s') > axes.index('r'):
+        expected = expected.T
+    assert result.shape == expected.shape + (4, 4)
+    assert np.allclose(result[..., 0, 0], expected)
+
+
+def test_batch_values_are_validated():
+    Inventory.load('param')
+    dataflow = DataFlow(cache=EvaluationCache())
+    sweep = Inventory.lookup_boxtype('param.Sweep')
+    dataflow.add_box(sweep(Inventory, name='whole', start=0, stop=8, count=5))
+    dataflow.add_box(sweep(Inventory, name='half', start=0, stop=2, count=5))
+    dataflow.add_box(sweep(Inventory, name='large', start=0, stop=20, count=3))
+    dataflow.add_box(BoxType(Count)(Inventory, name='count'))
+    assert not dataflow.allowed_link('half', '', 'count', 'count')
+    assert not dataflow.allowed_link('large', '', 'count', 'count')
+    dataflow.add_link('whole', '', 'count', 'count')
+    result = evaluate(dataflow.find_box('count').instance)
+    assert result.dtype.kind == 'i'
+    assert list(result[..., 0, 0].ravel()) == [0, 2, 4, 6, 8]
+
+
+def test_batch_is_not_linked_to_propagating_box():
+    Inventory.load('param')
+    Inventory.load('numbergen')
+    dataflow = DataFlow(cache=EvaluationCache())
+    dataflow.add_box(Inventory.lookup_boxtype('param.Sweep')(Inventory, name='s'))
+    dataflow.add_box(Inventory.lookup_boxtype('numbergen.BinaryOp')(
+        Inventory, name='op', operator='add', lhs=1, rhs=2))
+    assert not dataflow.allowed_link('s', '', 'op', 'lhs')
+    with pytest.raises(ValueError):
+        dataflow.find_box('op').set_param(lhs=dataflow.find_box('s').propagate())
+
+
+def test_axes_only_recomputed_for_boxes_declaring_them(monkeypatch):
+    dataflow = sweep_graph(('s', 'source', 'level'))
+    assert dataflow.axes == ['s', 'r']
+    calls = []
+    batch_axes = dataflow._batch_axes
+    monkeypatch.setattr(dataflow, '_batch_axes', lambda: calls.append(1) or batch_axes())
+    for i in range(10):
+        dataflow.add_box(BoxType(Source)(Inventory, name='source%d' % i))
+    dataflow.remove_box('source0')
+    assert not calls
+    dataflow.remove_box('r')
+    assert dataflow.axes == ['s'] and calls
@@ -0,0 +1,43 @@
+from __future__ import absolute_import
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+from boxflow.blur import engines, select_engine
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, 'benchmarks'))
+from blur import convolve # The 'convolve' path of the Blur box, reproduced
+
+tolerance = 0.02
+
+
+@pytest.mark.parametrize('size', [64, 101, 128, 300])
+def test_engines_match_convolve_where_selected(size):
+    arr = np.random.RandomState(size).rand(size, size)
+    selected = 0
+    for sigma in np.linspace(0.25, 16, 64):
+        if select_engine(sigma, arr.shape) == 'convolve':
+            continue
+        selected += 1
+        expected = convolve(arr, sigma)
+        for name, engine in engines.items():
+            error = np.abs(engine(arr, sigma) - expected).max()
+            assert error < tolerance, (name, sigma)
+    assert selected or size < 100
+
+
+@pytest.mark.parametrize('sigma', [0.25, 0.5, 1, 2, 3])
+def test_small_blurs_are_convolved(sigma):
+    assert select_engine(sigma, (1024, 1024)) == 'convolve'
+
+
+def test_blur_box_default_matches_convolve():
+    imagen = pytest.importorskip('imagen')
+    from boxflow.interface.imagen import Blur
+    for blur_amount in [10, 100, 400]:
+        auto = Blur(input=imagen.Disk(), blur_amount=blur_amount)()
+        convolved = Blur(input=imagen.Disk(), blur_amount=blur_amount, engine='convolve')()
+        assert np.abs(auto - convolved).max() < tolerance
@@ -0,0 +1,92 @@
+from __future__ import absolute_import
+
+import numpy as np
+import param
+import pytest
+
+from boxflow.cache import EvaluationCache, evaluate
+from boxflow.command import Command
+from boxflow.dataflow import DataFlow
+from boxflow.interface import Inventory
+from boxflow.interface.inventory import BoxType
+
+
+class Region(object):
+    "Unhashable bounds with an lbrt method, as the BoundingBox of imagen"
+    __hash__ = None
+
+    def __init__(self, radius):
+        self.radius = radius
+
+    def lbrt(self):
+        return (-self.radius, -self.radius, self.radius, self.radius)
+
+
+class Pattern(param.Parameterized):
+    bounds = param.Parameter(default=Region(0.5))
+    weights = param.Parameter(default=np.ones(3))
+    scale = param.Number(default=1.0)
+    calls = 0
+
+    def __call__(self, **params):
+        Pattern.calls += 1
+        return np.ones(4) * self.scale
+
+
+def session_graph(cache, name, **params):
+    "A pattern scaled by a BinaryOp, as built by one session"
+    Inventory.load('numbergen')
+    dataflow = DataFlow(cache=cache, shared=True)
+    dataflow.add_box(Inventory.lookup_boxtype('numbergen.BinaryOp')(
+        Inventory, name=name + '-op', operator='mul', lhs=2, rhs=3))
+    dataflow.add_box(BoxType(Pattern)(Inventory, name=name, **params))
+    dataflow.add_link(name + '-op', '', name, 'scale')
+    return dataflow.find_box(name)
+
+
+def test_identical_sessions_share_results():
+    cache = EvaluationCache()
+    first = session_graph(cache, 'a1', bounds=Region(0.5), weights=np.ones(3))
+    second = session_graph(cache, 'b7', bounds=Region(0.5), weights=np.ones(3))
+    assert first.key == second.key
+    evaluate(first.instance)
+    hits = cache.hits
+    evaluate(second.instance)
+    assert cache.hits == hits + 1
+
+
+def test_different_sessions_do_not_share_results():
+    cache = EvaluationCache()
+    first = session_graph(cache, 'a1', bounds=Region(0.5))
+    assert session_graph(cache, 'b7', bounds=Region(1.0)).key != first.key
+    assert session_graph(cache, 'c3', weights=np.zeros(3)).key != first.key
+
+
+def test_shared_key_size_is_independent_of_depth():
+    Inventory.load('param')
+    dataflow = DataFlow(cache=EvaluationCache(), shared=True)
+    number = Inventory.lookup_boxtype('param.Number')
+    names = ['n%d' % i for i in range(20)]
+    for name in names:
+        dataflow.add_box(number(Inventory, name=name))
+    for src, dest in zip(names, names[1:]):
+        dataflow.add_link(src, 'number', dest, 'number')
+    sizes = set(len(repr(dataflow.find_box(name).key)) for name in names)
+    assert len(sizes) == 1
+
+
+class Handler(object):
+    def write_message(self, message, binary=False):
+        pass
+
+
+def test_identical_imagen_sessions_share_results():
+    pytest.importorskip('imagen')
+    cache = EvaluationCache()
+    document = {'boxes': [{'type': 'imagen.Disk', 'name': 'disk', 'params': {}}],
+                'links': []}
+    commands = [Command(Handler(), Inventory, [], cache=cache) for _ in range(2)]
+    commands[0].dispatch({'command': 'load_graph', 'data': document})
+    hits = cache.hits
+    commands[1].dispatch({'command': 'load_graph', 'data': document}) # Displays the disk
+    assert cache.hits > hits
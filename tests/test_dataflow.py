@@ -0,0 +1,59 @@
+from __future__ import absolute_import
+
+import param
+import pytest
+
+from boxflow.cache import EvaluationCache, evaluate
+from boxflow.dataflow import DataFlow
+from boxflow.interface import Inventory
+
+
+@pytest.fixture(autouse=True)
+def reset_time():
+    time = param.Dynamic.time_fn()
+    yield
+    param.Dynamic.time_fn(time)
+
+
+def make_box(group, type_name, name, **params):
+    Inventory.load(group)
+    return Inventory.lookup_boxtype(group + '.' + type_name)(Inventory, name=name, **params)
+
+
+def test_time_advance_refreshes_random_source():
+    dataflow = DataFlow(cache=EvaluationCache())
+    dataflow.add_box(make_box('param', 'Time', 't'))
+    dataflow.add_box(make_box('param', 'Number', 'n'))
+    dataflow.add_box(make_box('numbergen', 'URandom', 'u'))
+    dataflow.add_link('t', '', 'n', 'number')
+    random = dataflow.find_box('u')
+    values = [evaluate(random.instance)]
+    for time in [1, 2, 3]:
+        updated = dataflow.update_params('t', {'time': time})
+        assert 'u' in updated
+        assert random.key[-1] == time
+        values.append(evaluate(random.instance))
+        assert values[-1] == random.instance() # Fresh evaluation at the time
+    assert len(set(values)) == len(values)
+
+
+def test_static_box_keeps_key_when_time_advances():
+    dataflow = DataFlow(cache=EvaluationCache())
+    dataflow.add_box(make_box('param', 'Time', 't'))
+    dataflow.add_box(make_box('param', 'Number', 'n'))
+    dataflow.add_box(make_box('param', 'Number', 'static'))
+    dataflow.add_link('t', '', 'n', 'number')
+    static = dataflow.find_box('static')
+    key = static.key
+    assert dataflow.update_params('t', {'time': 5}) == ['t', 'n']
+    assert static.key == key and not static.timed
+
+
+def test_stale_memo_is_not_used_at_another_time():
+    cache = EvaluationCache()
+    dataflow = DataFlow(cache=cache)
+    dataflow.add_box(make_box('numbergen', 'URandom', 'u'))
+    random = dataflow.find_box('u').instance
+    evaluate(random)
+    param.Dynamic.time_fn(7) # Without refreshing the DataFlow
+    assert evaluate(random) == random()
@@ -0,0 +1,47 @@
+from __future__ import absolute_import
+
+import numpy as np
+import param
+import pytest
+
+from boxflow import graph
+from boxflow.dataflow import DataFlow
+from boxflow.interface import Inventory
+from boxflow.interface.inventory import BoxType
+
+
+class Weighted(param.Parameterized):
+    weights = param.Parameter(default=None)
+    generator = param.Parameter(default=None, precedence=-1)
+
+
+def make_box(group, type_name, name, **params):
+    Inventory.load(group)
+    return Inventory.lookup_boxtype(group + '.' + type_name)(Inventory, name=name, **params)
+
+
+def test_export_import_round_trip():
+    dataflow = DataFlow()
+    dataflow.add_box(make_box('param', 'Number', 'n', number=4))
+    dataflow.add_box(make_box('numbergen', 'BinaryOp', 'default'))
+    dataflow.add_box(make_box('numbergen', 'BinaryOp', 'op', operator='mul', rhs=3))
+    dataflow.add_link('n', '', 'op', 'lhs')
+    document = graph.export_graph(dataflow)
+    params = {box['name']: box['params'] for box in document['boxes']}
+    assert params == {'n': {'number': 4}, 'default': {}, 'op': {'operator': 'mul', 'rhs': 3}}
+
+    imported, ordered = graph.import_graph(graph.loads(graph.dumps(document)), Inventory)
+    assert sorted(ordered) == ['default', 'n', 'op']
+    assert graph.export_graph(imported) == document
+    assert imported.find_box('op').instance() == 12
+
+
+def test_export_rejects_unserializable_params():
+    dataflow = DataFlow()
+    box = BoxType(Weighted)(Inventory, name='w', generator=np.random.RandomState(1))
+    dataflow.add_box(box)
+    assert graph.export_graph(dataflow)['boxes'][0]['params'] == {}
+    box.set_param(weights=np.ones(3))
+    with pytest.raises(Exception) as error:
+        graph.export_graph(dataflow)
+    assert 'weights' in str(error.value)